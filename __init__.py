@@ -6,8 +6,11 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.pool import Pool
-from wishlist import NereidUser, Wishlist, Product, \
-    ProductWishlistRelationship
+from wishlist import NereidUser, Wishlist, Product, Template, \
+    ProductWishlistRelationship, ProductWishlistPurge, ProductRecommendation, \
+    WishlistHistory, WishlistArchive, WishlistTombstone
+from digest import WishlistDigest, WishlistDigestRun, \
+    WishlistDigestConfiguration
 
 
 def register():
@@ -15,6 +18,15 @@ def register():
         NereidUser,
         Wishlist,
         Product,
+        Template,
         ProductWishlistRelationship,
+        ProductWishlistPurge,
+        ProductRecommendation,
+        WishlistHistory,
+        WishlistArchive,
+        WishlistTombstone,
+        WishlistDigest,
+        WishlistDigestRun,
+        WishlistDigestConfiguration,
         module='nereid_wishlist', type_='model'
     )
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+    consistency.py
+
+    Consistency checker for the wishlist tables.
+
+    The tables are scanned in chunks ordered by id, so memory stays bounded
+    by the chunk size, and each class of inconsistency is reported:
+
+    ``duplicate_links``
+        Links of the same product to the same wishlist, but the first.
+    ``orphaned_links``
+        Links to a missing wishlist or product.
+    ``ineligible_links``
+        Links to products which are not displayed on the eshop or whose
+        template is inactive.
+    ``inactive_user_wishlists``
+        Wishlists of inactive users.
+    ``duplicate_wishlists``
+        Wishlists with the same user, website and name, but the first.
+
+    With repair, duplicate, orphaned and ineligible links are deleted,
+    wishlists of inactive users are archived and duplicate wishlists are
+    merged into the first one. Every chunk is repaired and committed on its
+    own so the checker can run alongside live traffic::
+
+        python -m trytond.modules.nereid_wishlist.consistency \\
+            -c trytond.conf database --repair
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import argparse
+from collections import defaultdict
+
+from sql import Null
+from sql.aggregate import Count, Min
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+
+__all__ = ['ConsistencyChecker']
+
+
+class ConsistencyChecker(object):
+    """
+    Check, and optionally repair, the wishlist tables of the database of
+    the current transaction.
+    """
+
+    def __init__(self, repair=False, chunk_size=1000, commit=True):
+        self.repair = repair
+        self.chunk_size = chunk_size
+        self.commit = commit
+        self.report = defaultdict(int)
+
+    def run(self):
+        """
+        Run all the checks and return the number of inconsistencies found
+        for each class.
+        """
+        self.check_links()
+        self.check_wishlists()
+        return dict(self.report)
+
+    def _end_chunk(self, changed_wishlists=()):
+        Wishlist = Pool().get('wishlist.wishlist')
+
+        if not self.repair:
+            return
+        if changed_wishlists:
+            Wishlist._bump_version(list(changed_wishlists))
+        if self.commit:
+            Transaction().cursor.commit()
+
+    def _delete_links(self, ids, removed=None):
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+        relation = Relation.__table__()
+
+        if self.repair and ids:
+            if removed:
+                Tombstone.bury(removed)
+            Transaction().cursor.execute(*relation.delete(
+                where=reduce_ids(relation.id, ids)
+            ))
+
+    def check_links(self):
+        """
+        Scan product.wishlist-product for orphaned and ineligible links,
+        and for duplicate links within each chunk of wishlists.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Wishlist = pool.get('wishlist.wishlist')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        transaction = Transaction()
+        relation = Relation.__table__()
+        wishlist = Wishlist.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        last_id = 0
+        while True:
+            cursor = transaction.cursor
+            cursor.execute(*relation.join(
+                wishlist, 'LEFT', condition=(relation.wishlist == wishlist.id)
+            ).join(
+                product, 'LEFT', condition=(relation.product == product.id)
+            ).join(
+                template, 'LEFT', condition=(product.template == template.id)
+            ).select(
+                relation.id, relation.wishlist, wishlist.id, relation.product,
+                product.id, product.displayed_on_eshop, template.active,
+                where=(relation.id > last_id),
+                order_by=relation.id.asc,
+                limit=self.chunk_size
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            orphaned, ineligible = [], []
+            removed = defaultdict(list)
+            for (id_, wishlist_id, exists, product_id, product_exists,
+                    displayed, active) in rows:
+                if exists is None or product_exists is None:
+                    orphaned.append(id_)
+                    if exists is not None:
+                        removed[wishlist_id].append(product_id)
+                elif not displayed or not active:
+                    ineligible.append(id_)
+                    removed[wishlist_id].append(product_id)
+            self.report['orphaned_links'] += len(orphaned)
+            self.report['ineligible_links'] += len(ineligible)
+            self._delete_links(orphaned + ineligible, removed)
+            self._end_chunk(set(removed))
+
+        self.check_duplicate_links()
+
+    def check_duplicate_links(self):
+        """
+        Find the products linked more than once to a wishlist, walking the
+        wishlists in chunks.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Wishlist = pool.get('wishlist.wishlist')
+        transaction = Transaction()
+        wishlist = Wishlist.__table__()
+        relation = Relation.__table__()
+
+        last_id = 0
+        while True:
+            cursor = transaction.cursor
+            cursor.execute(*wishlist.select(
+                wishlist.id,
+                where=(wishlist.id > last_id),
+                order_by=wishlist.id.asc,
+                limit=self.chunk_size
+            ))
+            wishlist_ids = [id_ for id_, in cursor.fetchall()]
+            if not wishlist_ids:
+                break
+            last_id = wishlist_ids[-1]
+
+            cursor.execute(*relation.select(
+                relation.wishlist, relation.product, Min(relation.id),
+                where=reduce_ids(relation.wishlist, wishlist_ids),
+                group_by=[relation.wishlist, relation.product],
+                having=Count(relation.id) > 1
+            ))
+            duplicates = cursor.fetchall()
+            if not duplicates:
+                continue
+
+            duplicate_ids = []
+            for wishlist_id, product_id, first_id in duplicates:
+                cursor.execute(*relation.select(
+                    relation.id,
+                    where=(relation.wishlist == wishlist_id)
+                    & (relation.product == product_id)
+                    & (relation.id != first_id)
+                ))
+                duplicate_ids.extend([id_ for id_, in cursor.fetchall()])
+            self.report['duplicate_links'] += len(duplicate_ids)
+            self._delete_links(duplicate_ids)
+            self._end_chunk(set(d[0] for d in duplicates))
+
+    def check_wishlists(self):
+        """
+        Find the wishlists of inactive users and the duplicate wishlists,
+        walking the users in chunks.
+        """
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        WishlistArchive = pool.get('wishlist.wishlist.archive')
+        NereidUser = pool.get('nereid.user')
+        transaction = Transaction()
+        wishlist = Wishlist.__table__()
+        user = NereidUser.__table__()
+
+        last_id = 0
+        while True:
+            cursor = transaction.cursor
+            cursor.execute(*user.select(
+                user.id, user.active,
+                where=(user.id > last_id),
+                order_by=user.id.asc,
+                limit=self.chunk_size
+            ))
+            users = cursor.fetchall()
+            if not users:
+                break
+            last_id = users[-1][0]
+
+            inactive = [id_ for id_, active in users if not active]
+            if inactive:
+                cursor.execute(*wishlist.select(
+                    wishlist.id, wishlist.nereid_user, wishlist.website,
+                    wishlist.name, wishlist.public,
+                    where=reduce_ids(wishlist.nereid_user, inactive)
+                ))
+                rows = cursor.fetchall()
+                self.report['inactive_user_wishlists'] += len(rows)
+                if self.repair and rows:
+                    WishlistArchive.archive_rows(rows)
+
+            cursor.execute(*wishlist.select(
+                wishlist.nereid_user, wishlist.website, wishlist.name,
+                Min(wishlist.id),
+                where=reduce_ids(wishlist.nereid_user, [u[0] for u in users]),
+                group_by=[
+                    wishlist.nereid_user, wishlist.website, wishlist.name,
+                ],
+                having=Count(wishlist.id) > 1
+            ))
+            for user_id, website_id, name, first_id in cursor.fetchall():
+                website_clause = (wishlist.website == website_id) \
+                    if website_id is not None else (wishlist.website == Null)
+                cursor.execute(*wishlist.select(
+                    wishlist.id,
+                    where=(wishlist.nereid_user == user_id)
+                    & website_clause
+                    & (wishlist.name == name)
+                    & (wishlist.id != first_id)
+                ))
+                duplicates = Wishlist.browse(
+                    [id_ for id_, in cursor.fetchall()]
+                )
+                self.report['duplicate_wishlists'] += len(duplicates)
+                if self.repair:
+                    target = Wishlist(first_id)
+                    for duplicate in duplicates:
+                        Wishlist.merge(duplicate, target)
+            self._end_chunk()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check and repair the wishlist tables'
+    )
+    parser.add_argument('database')
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument(
+        '--repair', action='store_true',
+        help='repair the inconsistencies found'
+    )
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    options = parser.parse_args(argv)
+
+    from trytond.config import config
+    config.update_etc(options.config)
+
+    Pool.start()
+    pool = Pool(options.database)
+    pool.init()
+
+    with Transaction().start(options.database, 0, context={}):
+        report = ConsistencyChecker(
+            repair=options.repair, chunk_size=options.chunk_size
+        ).run()
+
+    for name in sorted(report):
+        print('%s: %d' % (name, report[name]))
+    return 1 if any(report.values()) and not options.repair else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
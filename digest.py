@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+    digest.py
+
+    Weekly digests of the products waiting in wishlists.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import logging
+from collections import OrderedDict
+
+from trytond.pool import Pool
+from trytond.model import ModelSQL, ModelSingleton, fields
+from trytond.transaction import Transaction
+
+__all__ = [
+    'WishlistDigest', 'WishlistDigestRun', 'WishlistDigestConfiguration',
+]
+
+logger = logging.getLogger(__name__)
+
+_environment = None
+
+
+def _get_environment():
+    global _environment
+    if _environment is None:
+        from jinja2 import Environment, FileSystemLoader
+        _environment = Environment(loader=FileSystemLoader(
+            os.path.join(os.path.dirname(__file__), 'emails')
+        ))
+    return _environment
+
+
+def _render(context):
+    """
+    Render the digest of one user from the plain data of the context.
+    """
+    template = _get_environment().get_template('wishlist-digest.jinja')
+    return template.render(**context)
+
+
+class WishlistDigest(ModelSQL):
+    """
+    Outbox of the wishlist digest emails.
+
+    The emails are queued by generate and sent by the mail delivery
+    process, which marks them as sent.
+    """
+    __name__ = 'wishlist.digest'
+
+    run = fields.Many2One(
+        'wishlist.digest.run', 'Run', required=True, ondelete='CASCADE',
+        select=True,
+    )
+    nereid_user = fields.Many2One(
+        'nereid.user', 'Nereid User', required=True, ondelete='CASCADE'
+    )
+    to_address = fields.Char('To', required=True)
+    subject = fields.Char('Subject', required=True)
+    body = fields.Text('Body', required=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('sent', 'Sent'),
+    ], 'State', required=True, select=True)
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @classmethod
+    def get_subject(cls, language):
+        """
+        Return the subject of the digest translated in language.
+        """
+        Configuration = Pool().get('wishlist.digest.configuration')
+
+        with Transaction().set_context(
+                language=language or Transaction().language):
+            return Configuration(1).subject
+
+    @classmethod
+    def _get_languages(cls, user_ids):
+        """
+        Return a dictionary of the language code of the party of each user.
+        """
+        NereidUser = Pool().get('nereid.user')
+        return dict(
+            (user.id, user.party.lang and user.party.lang.code)
+            for user in NereidUser.browse(user_ids)
+        )
+
+    @classmethod
+    def _get_users(cls, last_id, chunk_size):
+        """
+        Return the next chunk_size (id, email, display_name) rows of the
+        active users after last_id.
+        """
+        NereidUser = Pool().get('nereid.user')
+        cursor = Transaction().cursor
+        user = NereidUser.__table__()
+
+        cursor.execute(*user.select(
+            user.id, user.email, user.display_name,
+            where=(user.id > last_id) & (user.active == True),  # noqa
+            order_by=user.id.asc,
+            limit=chunk_size
+        ))
+        return cursor.fetchall()
+
+    @classmethod
+    def _get_wishlists(cls, user_ids):
+        """
+        Return the wishlists and the eligible products of the users with one
+        query, as a dictionary of user id to an ordered dictionary of
+        wishlist name to product names.
+        """
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        Relation = pool.get('product.wishlist-product')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        cursor = Transaction().cursor
+        wishlist = Wishlist.__table__()
+        relation = Relation.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        cursor.execute(*wishlist.join(
+            relation, condition=(relation.wishlist == wishlist.id)
+        ).join(
+            product, condition=(relation.product == product.id)
+        ).join(
+            template, condition=(product.template == template.id)
+        ).select(
+            wishlist.nereid_user, wishlist.name, template.name,
+            where=wishlist.nereid_user.in_(user_ids)
+            & (product.displayed_on_eshop == True)  # noqa
+            & (template.active == True),  # noqa
+            order_by=[wishlist.nereid_user, wishlist.id, relation.id]
+        ))
+        result = {}
+        for user_id, wishlist_name, product_name in cursor.fetchall():
+            wishlists = result.setdefault(user_id, OrderedDict())
+            wishlists.setdefault(wishlist_name, []).append(product_name)
+        return result
+
+    @classmethod
+    def generate(cls, chunk_size=500, commit=True):
+        """
+        Queue the digest of every active user with wishlisted products.
+
+        Users are streamed chunk_size at a time and the wishlists of each
+        chunk are read with one query. The emails are rendered from plain
+        data, without touching the database, and queued with one create
+        per chunk with the subject in the language of each user. The last
+        user of every chunk is checkpointed on the run, so an interrupted
+        run resumes after it.
+        """
+        Run = Pool().get('wishlist.digest.run')
+        transaction = Transaction()
+
+        run = Run.get_current()
+        subjects = {}
+        while True:
+            users = cls._get_users(run.last_user, chunk_size)
+            if not users:
+                break
+            wishlists = cls._get_wishlists([u[0] for u in users])
+
+            recipients = [u for u in users if u[0] in wishlists]
+            languages = cls._get_languages([u[0] for u in recipients])
+            for language in set(languages.values()) - set(subjects):
+                subjects[language] = cls.get_subject(language)
+            bodies = [_render({
+                'user': {'name': name, 'email': email},
+                'wishlists': [{
+                    'name': wishlist_name,
+                    'items': [{'name': p} for p in products],
+                } for wishlist_name, products in
+                    wishlists[user_id].items()],
+            }) for user_id, email, name in recipients]
+
+            cls.create([{
+                'run': run.id,
+                'nereid_user': user_id,
+                'to_address': email,
+                'subject': subjects[languages[user_id]],
+                'body': body,
+            } for (user_id, email, _), body in zip(recipients, bodies)])
+            Run.write([run], {'last_user': users[-1][0]})
+            if commit:
+                transaction.cursor.commit()
+            logger.info(
+                'Queued %d wishlist digests up to user %d',
+                len(recipients), users[-1][0]
+            )
+
+        Run.write([run], {'state': 'done'})
+        return run
+
+
+class WishlistDigestRun(ModelSQL):
+    """
+    Checkpoint of a run of the wishlist digest generation.
+    """
+    __name__ = 'wishlist.digest.run'
+
+    state = fields.Selection([
+        ('running', 'Running'),
+        ('done', 'Done'),
+    ], 'State', required=True, select=True)
+    last_user = fields.Integer(
+        'Last User', required=True,
+        help='The id of the last user whose digest was queued'
+    )
+
+    @staticmethod
+    def default_state():
+        return 'running'
+
+    @staticmethod
+    def default_last_user():
+        return 0
+
+    @classmethod
+    def get_current(cls):
+        """
+        Return the interrupted run if there is one or a new run.
+        """
+        runs = cls.search([('state', '=', 'running')], limit=1)
+        if runs:
+            return runs[0]
+        run, = cls.create([{}])
+        return run
+
+
+class WishlistDigestConfiguration(ModelSingleton, ModelSQL):
+    """
+    Configuration of the wishlist digests.
+    """
+    __name__ = 'wishlist.digest.configuration'
+
+    subject = fields.Char('Subject', required=True, translate=True)
+
+    @staticmethod
+    def default_subject():
+        return 'Items in your wishlist'
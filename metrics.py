@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+
+    In-process metrics of the wishlist operations.
+
+    Every thread accumulates into its own store so that recording a value
+    takes no lock; the stores are only summed when the metrics are
+    exposed, and the stores of the threads which ended are folded into a
+    single one. Each worker process has its own registry and is scraped on its
+    own.
+
+    Reading the metrics is configured on the nereid application, it is
+    denied when neither is set:
+
+    ``WISHLIST_METRICS_ALLOWED``
+        Addresses which may read the metrics. Behind a proxy every client
+        has the address of the proxy, so they should only be used together
+        with a fix of remote_addr such as werkzeug's ProxyFix.
+    ``WISHLIST_METRICS_TOKEN``
+        Requests with an ``Authorization: Bearer <token>`` header carrying
+        this token may read the metrics.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import hmac
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from collections import defaultdict
+
+from werkzeug.exceptions import HTTPException
+from nereid import request, current_app
+
+__all__ = ['registry', 'instrumented', 'may_read_metrics']
+
+#: Form actions used as label, anything else is labelled with the method
+#: to keep the number of series bounded
+ACTIONS = ('add', 'remove')
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.,
+)
+
+
+def _new_store():
+    return {
+        'counter': defaultdict(float),
+        'histogram': {},
+    }
+
+
+def _merge(into, store):
+    """
+    Add the values of the store into another one.
+    """
+    for key, value in list(store['counter'].items()):
+        into['counter'][key] += value
+    histograms = into['histogram']
+    for key, (counts, total) in list(store['histogram'].items()):
+        if key in histograms:
+            previous, previous_total = histograms[key]
+            counts = [a + b for a, b in zip(previous, counts)]
+            total += previous_total
+        histograms[key] = (list(counts), total)
+
+
+class Registry(object):
+    """
+    Registry of counters and histograms.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        #: Store of each thread which recorded a value
+        self._stores = {}
+        #: Values of the threads which ended
+        self._retired = _new_store()
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def define(self, name, type_, help_, buckets=DEFAULT_BUCKETS):
+        assert type_ in ('counter', 'histogram')
+        self._metrics[name] = (type_, help_, tuple(buckets))
+
+    def _store(self):
+        try:
+            return self._local.store
+        except AttributeError:
+            store = self._local.store = _new_store()
+            with self._lock:
+                self._retire()
+                self._stores[threading.current_thread()] = store
+            return store
+
+    def _retire(self):
+        """
+        Fold the stores of the threads which ended into the retired store,
+        they are not written anymore. It must be called with the lock.
+        """
+        for thread in list(self._stores):
+            if not thread.is_alive():
+                _merge(self._retired, self._stores.pop(thread))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._store()['counter'][key] += value
+
+    def observe(self, name, value, **labels):
+        buckets = self._metrics[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        histograms = self._store()['histogram']
+        try:
+            counts, total = histograms[key]
+        except KeyError:
+            counts, total = [0] * (len(buckets) + 1), 0.
+        counts[bisect_left(buckets, value)] += 1
+        histograms[key] = (counts, total + value)
+
+    def collect(self):
+        """
+        Return the counters and the histograms summed over all threads.
+        """
+        with self._lock:
+            self._retire()
+            stores = list(self._stores.values())
+            total = _new_store()
+            _merge(total, self._retired)
+        for store in stores:
+            _merge(total, store)
+        return total['counter'], total['histogram']
+
+    def exposition(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        counters, histograms = self.collect()
+        series = defaultdict(list)
+        for (name, labels), value in counters.items():
+            series[name].append((labels, value))
+        for (name, labels), value in histograms.items():
+            series[name].append((labels, value))
+
+        lines = []
+        for name in sorted(self._metrics):
+            type_, help_, buckets = self._metrics[name]
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, type_))
+            for labels, value in sorted(series[name]):
+                if type_ == 'counter':
+                    lines.append('%s%s %s' % (
+                        name, _format_labels(labels), _format_value(value)
+                    ))
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name,
+                        _format_labels(labels + (('le', str(bound)),)),
+                        cumulative,
+                    ))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(labels), _format_value(total)
+                ))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(labels), cumulative
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, _escape_label(value)) for key, value in labels
+    )
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == int(value):
+        return '%d' % value
+    return repr(value)
+
+
+registry = Registry()
+registry.define(
+    'wishlist_requests_total', 'counter',
+    'Requests to the wishlist routes by route, action and status.'
+)
+registry.define(
+    'wishlist_request_duration_seconds', 'histogram',
+    'Latency of the wishlist routes by route and action.'
+)
+registry.define(
+    'wishlist_created_total', 'counter',
+    'Wishlists created by _search_or_create_wishlist.'
+)
+registry.define(
+    'wishlist_ineligible_product_total', 'counter',
+    'Products rejected with 404 by the eligibility check.'
+)
+
+
+def may_read_metrics():
+    """
+    Return True if the current request may read the metrics according to
+    the application configuration.
+    """
+    config = current_app.config
+    if request.remote_addr in config.get('WISHLIST_METRICS_ALLOWED', ()):
+        return True
+    token = config.get('WISHLIST_METRICS_TOKEN')
+    if not token:
+        return False
+    header = request.headers.get('Authorization', '')
+    return hmac.compare_digest(
+        header.encode('utf-8'), ('Bearer %s' % token).encode('utf-8')
+    )
+
+
+def _status(rv):
+    if isinstance(rv, tuple):
+        return rv[1]
+    return getattr(rv, 'status_code', 200)
+
+
+def instrumented(function):
+    """
+    Count the requests to the decorated route and record their latency.
+
+    The action label is the add or remove action of the form when there is
+    one and the lower cased HTTP method otherwise.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        status = 500
+        try:
+            rv = function(*args, **kwargs)
+            status = _status(rv)
+            return rv
+        except HTTPException as exception:
+            status = exception.code
+            raise
+        finally:
+            action = request.form.get('action')
+            if action not in ACTIONS:
+                action = request.method.lower()
+            labels = {
+                'route': request.endpoint or function.__name__,
+                'action': action,
+            }
+            registry.observe(
+                'wishlist_request_duration_seconds', time.time() - start,
+                **labels
+            )
+            registry.inc('wishlist_requests_total', status=status, **labels)
+    return wrapper
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    profiling.py
+
+    Opt-in profiling of the wishlist routes.
+
+    Profiling is configured on the nereid application:
+
+    ``WISHLIST_PROFILE_DIR``
+        Directory where the profiles are written. Profiling is disabled
+        when it is not set.
+    ``WISHLIST_PROFILE_RATE``
+        Fraction of the requests which are profiled (default: 0).
+    ``WISHLIST_PROFILE_HEADER``
+        Name of the header requesting a profile (default: X-Wishlist-Profile).
+    ``WISHLIST_PROFILE_SECRET``
+        Requests whose profile header has this value are always profiled.
+        The header is ignored when it is not set.
+
+    Each profiled request writes a ``.prof`` file, readable with
+    :mod:`pstats`, snakeviz or gprof2dot, and a ``.json`` file with the time
+    spent in the ORM, in SQL and in template rendering.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import hmac
+import json
+import time
+import random
+from functools import wraps
+
+from nereid import request, current_app
+
+from replica import rendered
+
+__all__ = ['profiled']
+
+#: Ordered (phase, path fragments) used to attribute the own time of a
+#: function to a phase
+PHASES = [
+    ('sql', (
+        'trytond/backend', 'psycopg2', 'sqlite3', "'sql.", 'sql/__init__',
+    )),
+    ('template', ('jinja2', 'nereid/templating')),
+    ('orm', ('trytond/',)),
+]
+
+
+def _phase(filename, function):
+    location = '%s %s' % (filename, function)
+    for phase, fragments in PHASES:
+        if any(fragment in location for fragment in fragments):
+            return phase
+    return 'other'
+
+
+def _must_profile(config):
+    secret = config.get('WISHLIST_PROFILE_SECRET')
+    if secret:
+        value = request.headers.get(
+            config.get('WISHLIST_PROFILE_HEADER', 'X-Wishlist-Profile'), ''
+        )
+        # Constant time, the secret must not leak through the timing
+        if hmac.compare_digest(value.encode('utf-8'), secret.encode('utf-8')):
+            return True
+    return random.random() < config.get('WISHLIST_PROFILE_RATE', 0)
+
+
+def phase_timings(profile):
+    """
+    Return a dictionary of the own time in seconds spent in each phase of
+    the profile.
+    """
+    import pstats
+
+    timings = dict.fromkeys([p for p, _ in PHASES] + ['other'], 0.)
+    stats = pstats.Stats(profile)
+    for (filename, _, function), values in stats.stats.items():
+        timings[_phase(filename, function)] += values[2]
+    return timings
+
+
+def _write_profile(directory, endpoint, profile, elapsed):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    basename = os.path.join(directory, '%s-%d-%s' % (
+        time.strftime('%Y%m%d%H%M%S'), os.getpid(), endpoint,
+    ))
+    profile.dump_stats(basename + '.prof')
+
+    with open(basename + '.json', 'w') as summary:
+        json.dump({
+            'endpoint': endpoint,
+            'path': request.path,
+            'method': request.method,
+            'elapsed': elapsed,
+            'phases': phase_timings(profile),
+        }, summary, indent=2, sort_keys=True)
+
+
+def profiled(function):
+    """
+    Profile the decorated route according to the application
+    configuration.
+
+    When WISHLIST_PROFILE_DIR is not set the route is called directly.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        directory = config.get('WISHLIST_PROFILE_DIR')
+        if not directory or not _must_profile(config):
+            return function(*args, **kwargs)
+
+        import cProfile
+
+        profile = cProfile.Profile()
+        start = time.time()
+        profile.enable()
+        try:
+            # Templates are rendered lazily, render them while profiling
+            response = rendered(function(*args, **kwargs))
+        finally:
+            profile.disable()
+            elapsed = time.time() - start
+        _write_profile(
+            directory, request.endpoint or function.__name__, profile, elapsed
+        )
+        return response
+    return wrapper
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+    ratelimit.py
+
+    Token bucket rate limiting of the wishlist write routes.
+
+    Rate limiting is configured on the nereid application:
+
+    ``WISHLIST_RATE_LIMIT``
+        A (capacity, rate) tuple: every user may burst capacity writes and
+        then rate writes per second. Users are not limited when it is not
+        set.
+    ``WISHLIST_RATE_LIMIT_IP``
+        A (capacity, rate) tuple limiting every client address in the same
+        way. Many users may share an address, so it is usually looser than
+        the user limit. Addresses are not limited when it is not set.
+    ``WISHLIST_RATE_BACKEND``
+        Store of the buckets (default: a MemoryBackend of the worker
+        process). A RedisBackend shares the buckets between workers.
+
+    Rejected requests are answered with 429 and a Retry-After header
+    before the session user is loaded, so they never reach the ORM.
+
+    The address is the remote_addr of the request, which must be the
+    address of the client: behind a reverse proxy every request comes
+    from the proxy, so the application must be wrapped to read the
+    address forwarded by the proxy, e.g. with werkzeug's ProxyFix.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import math
+import time
+import threading
+from functools import wraps
+
+from nereid import request, current_app
+from flask import session, make_response
+
+__all__ = ['MemoryBackend', 'RedisBackend', 'rate_limited']
+
+#: Methods which are not limited
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class MemoryBackend(object):
+    """
+    Token buckets kept in the worker process.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._prune_size = 1024
+
+    def consume(self, key, capacity, rate):
+        """
+        Take a token from the bucket of key, which holds up to capacity
+        tokens and gains rate tokens per second.
+
+        Return 0 if a token was taken and otherwise the number of seconds
+        until one is available.
+        """
+        now = time.time()
+        with self._lock:
+            tokens, last, _ = self._buckets.get(key, (capacity, now, 0))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            if tokens >= 1:
+                tokens, wait = tokens - 1, 0.
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now, capacity / float(rate))
+            if len(self._buckets) >= self._prune_size:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # Full buckets are the same as missing ones. Pruning when the size
+        # doubles keeps the cost per check constant on average.
+        for key, (_, last, full) in list(self._buckets.items()):
+            if now - last >= full:
+                del self._buckets[key]
+        self._prune_size = max(1024, 2 * len(self._buckets))
+
+
+class RedisBackend(object):
+    """
+    Token buckets shared by the workers in Redis, updated atomically by a
+    script. client is a redis.StrictRedis instance.
+    """
+    SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+        local tokens = tonumber(bucket[1]) or capacity
+        local last = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens),
+            'time', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, client, prefix='wishlist-rate:'):
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    def consume(self, key, capacity, rate):
+        return float(self._script(
+            keys=[self.prefix + key], args=[capacity, rate, time.time()]
+        ))
+
+
+_memory_backend = MemoryBackend()
+
+
+def _limits(config):
+    # The user id is read from the session, loading the user would query
+    # the database
+    limits = []
+    if config.get('WISHLIST_RATE_LIMIT_IP'):
+        limits.append((
+            'ip:%s' % request.remote_addr, config['WISHLIST_RATE_LIMIT_IP']
+        ))
+    user_id = session.get('user_id')
+    if config.get('WISHLIST_RATE_LIMIT') and user_id:
+        limits.append(('user:%s' % user_id, config['WISHLIST_RATE_LIMIT']))
+    return limits
+
+
+def rate_limited(function):
+    """
+    Limit the writes to the decorated route per user and per client
+    address according to the application configuration.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        if request.method in SAFE_METHODS:
+            return function(*args, **kwargs)
+        limits = _limits(config)
+        if not limits:
+            return function(*args, **kwargs)
+
+        backend = config.get('WISHLIST_RATE_BACKEND') or _memory_backend
+        wait = max(
+            backend.consume(key, capacity, rate)
+            for key, (capacity, rate) in limits
+        )
+        if wait:
+            response = make_response('Too Many Requests', 429)
+            response.headers['Retry-After'] = str(int(math.ceil(wait)))
+            return response
+        return function(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    replica.py
+
+    Routing of the read-only wishlist requests to a replica database.
+
+    Routing is configured on the nereid application:
+
+    ``WISHLIST_REPLICA_DATABASE``
+        Name of the replica database, on the same server URI as the primary.
+        Every request reads from the primary when it is not set.
+    ``WISHLIST_REPLICA_PIN``
+        Seconds during which a user who wrote is pinned to the primary, so
+        that they read their own writes (default: 10). It should be longer
+        than the replication lag.
+
+    Only GET and HEAD requests are routed to the replica, writes always go
+    to the primary.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from functools import wraps
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.transaction import Transaction
+from nereid import request, current_app
+from nereid.templating import LazyRenderer
+from flask import has_request_context, session, make_response
+
+__all__ = [
+    'read_replica', 'replica_reads', 'pin_primary', 'use_replica', 'rendered',
+]
+
+SESSION_KEY = 'wishlist_primary_until'
+
+
+def pin_primary():
+    """
+    Pin the session of the current request to the primary for
+    WISHLIST_REPLICA_PIN seconds.
+    """
+    if not has_request_context():
+        return
+    config = current_app.config
+    if config.get('WISHLIST_REPLICA_DATABASE'):
+        session[SESSION_KEY] = time.time() + \
+            config.get('WISHLIST_REPLICA_PIN', 10)
+
+
+def use_replica():
+    """
+    Return True if the current request may read from the replica.
+    """
+    if not has_request_context():
+        return False
+    if not current_app.config.get('WISHLIST_REPLICA_DATABASE'):
+        return False
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    return session.get(SESSION_KEY, 0) < time.time()
+
+
+class _ReplicaCursor(object):
+    """
+    Cursor of the replica which answers to the database name of the
+    primary, so that the pool and the caches of the primary are used with
+    it. Everything else is delegated to the cursor of the replica.
+    """
+
+    def __init__(self, cursor, database_name):
+        self._cursor = cursor
+        self.database_name = database_name
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@contextmanager
+def read_replica():
+    """
+    Run the block on a cursor of the replica when the current request may
+    read from it, and on the cursor of the transaction otherwise.
+    """
+    if not use_replica():
+        yield
+        return
+
+    transaction = Transaction()
+    primary = transaction.cursor
+    Database = backend.get('Database')
+    database = Database(
+        current_app.config['WISHLIST_REPLICA_DATABASE']
+    ).connect()
+    cursor = _ReplicaCursor(database.cursor(), primary.database_name)
+    transaction.set_cursor(cursor)
+    try:
+        yield
+    finally:
+        transaction.set_cursor(primary)
+        cursor.rollback()
+        cursor.close()
+
+
+def rendered(rv):
+    """
+    Return the response of the return value of a route with its templates
+    rendered, as they are rendered lazily.
+
+    A LazyRenderer is converted the way the nereid dispatcher does, flask
+    can not make a response of it.
+    """
+    if isinstance(rv, LazyRenderer):
+        rv = (unicode(rv), rv.status, rv.headers)
+    response = make_response(rv)
+    response.get_data()
+    return response
+
+
+def replica_reads(function):
+    """
+    Run the GET and HEAD requests of the decorated route, and the
+    rendering of their templates, on the replica.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not use_replica():
+            return function(*args, **kwargs)
+        with read_replica():
+            return rendered(function(*args, **kwargs))
+    return wrapper
@@ -118,7 +118,7 @@ setup(
         'trytond.modules.%s' % MODULE: info.get('xml', [])
         + info.get('translation', [])
         + ['tryton.cfg', 'locale/*.po', 'tests/*.rst', 'reports/*.odt']
-        + ['view/*.xml'],
+        + ['view/*.xml', 'emails/*.jinja'],
     },
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -11,6 +11,7 @@ import trytond.tests.test_tryton
 
 from tests.test_views_depends import TestViewsDepends
 from tests.test_wishlist import TestWishlist
+from tests.test_import_time import TestImportTime
 
 
 def suite():
@@ -21,6 +22,7 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestViewsDepends),
         unittest.TestLoader().loadTestsFromTestCase(TestWishlist),
+        unittest.TestLoader().loadTestsFromTestCase(TestImportTime),
     ])
     return test_suite
 
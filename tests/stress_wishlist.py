@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/stress_wishlist.py
+
+    Concurrent stress harness for the wishlist routes.
+
+    Many simulated users add and remove products, list their wishlists and
+    create the Default wishlist from a pool of threads or processes. At the
+    end the throughput and latency percentiles are reported and the tables
+    are checked for duplicate wishlists, duplicate links and orphaned
+    links.
+
+    The database is shared between the workers so it can not be an in
+    memory SQLite database::
+
+        TRYTOND_DATABASE_URI=sqlite:// DB_NAME=/tmp/stress.sqlite \\
+            python -m tests.stress_wishlist --users 20 --threads 8
+
+        TRYTOND_DATABASE_URI=postgresql://localhost/ DB_NAME=stress \\
+            python -m tests.stress_wishlist --processes 4
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+from decimal import Decimal
+
+from sql import Null
+from sql.aggregate import Count
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+
+from tests.test_wishlist import TestWishlist
+
+PASSWORD = 'password'
+
+
+def setup_fixtures(users, products):
+    """
+    Create the website, the users and the products used by the workers
+    and commit them.
+
+    Return a tuple of the user emails and the product ids.
+    """
+    trytond.tests.test_tryton.install_module('nereid_wishlist')
+    case = TestWishlist('test_0010_create_wishlist')
+    case.setUp()
+
+    NereidUser = POOL.get('nereid.user')
+    Party = POOL.get('party.party')
+    Uom = POOL.get('product.uom')
+    Template = POOL.get('product.template')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        case.setup_defaults()
+
+        emails = ['stress%d@example.com' % i for i in range(users)]
+        parties = Party.create([{'name': email} for email in emails])
+        NereidUser.create([{
+            'party': party.id,
+            'display_name': email,
+            'email': email,
+            'password': PASSWORD,
+            'company': case.company.id,
+        } for party, email in zip(parties, emails)])
+
+        uom, = Uom.search([], limit=1)
+        templates = Template.create([{
+            'name': 'Stress-%d' % i,
+            'type': 'goods',
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'default_uom': uom.id,
+            'products': [('create', [{
+                'uri': 'stress-%d' % i,
+                'displayed_on_eshop': True,
+            }])],
+        } for i in range(products)])
+        product_ids = [t.products[0].id for t in templates]
+
+        transaction.cursor.commit()
+    return emails, product_ids
+
+
+def get_app():
+    case = TestWishlist('test_0010_create_wishlist')
+    case.setUp()
+    return case.get_app()
+
+
+def simulate_user(app, email, product_ids, requests, seed):
+    """
+    Run the requests of one user and return a tuple of the latencies of
+    the requests and the number of failed requests.
+    """
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+
+    with app.test_client() as c:
+        c.post('/login', data={'email': email, 'password': PASSWORD})
+
+        for _ in range(requests):
+            operation = rng.random()
+            start = time.time()
+            try:
+                if operation < 0.6:
+                    # wishlist_product, creating the Default wishlist
+                    # through _search_or_create_wishlist on first use
+                    rv = c.post('/wishlists/products', data={
+                        'product': rng.choice(product_ids),
+                        'action': rng.choice(['add', 'add', 'remove']),
+                    })
+                elif operation < 0.8:
+                    rv = c.get('/wishlists')
+                else:
+                    rv = c.post('/wishlists', data={'name': 'Default'})
+            except Exception:
+                errors += 1
+            else:
+                if rv.status_code >= 500:
+                    errors += 1
+            latencies.append(time.time() - start)
+    return latencies, errors
+
+
+def _process_worker(args):
+    emails, product_ids, requests, seed = args
+    app = get_app()
+    latencies, errors = [], 0
+    for i, email in enumerate(emails):
+        result = simulate_user(app, email, product_ids, requests, seed + i)
+        latencies.extend(result[0])
+        errors += result[1]
+    return latencies, errors
+
+
+def run_threads(emails, product_ids, requests, threads, seed):
+    app = get_app()
+    results = []
+    lock = threading.Lock()
+    queue = list(emails)
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                email = queue.pop()
+                user_seed = seed + len(queue)
+            result = simulate_user(
+                app, email, product_ids, requests, user_seed
+            )
+            with lock:
+                results.append(result)
+
+    workers = [
+        threading.Thread(target=worker) for _ in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
+
+def run_processes(emails, product_ids, requests, processes, seed):
+    chunks = [emails[i::processes] for i in range(processes)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_process_worker, [
+            (chunk, product_ids, requests, seed + i * len(emails))
+            for i, chunk in enumerate(chunks) if chunk
+        ])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def check_invariants():
+    """
+    Return a dictionary of the violated invariants with the offending
+    rows.
+    """
+    Wishlist = POOL.get('wishlist.wishlist')
+    Relation = POOL.get('product.wishlist-product')
+    Product = POOL.get('product.product')
+
+    violations = {}
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        cursor = transaction.cursor
+        wishlist = Wishlist.__table__()
+        relation = Relation.__table__()
+        product = Product.__table__()
+
+        cursor.execute(*wishlist.select(
+            wishlist.website, wishlist.nereid_user, wishlist.name,
+            Count(wishlist.id),
+            group_by=[wishlist.website, wishlist.nereid_user, wishlist.name],
+            having=Count(wishlist.id) > 1
+        ))
+        violations['duplicate wishlists'] = cursor.fetchall()
+
+        cursor.execute(*relation.select(
+            relation.wishlist, relation.product, Count(relation.id),
+            group_by=[relation.wishlist, relation.product],
+            having=Count(relation.id) > 1
+        ))
+        violations['duplicate links'] = cursor.fetchall()
+
+        cursor.execute(*relation.join(
+            wishlist, 'LEFT', condition=(relation.wishlist == wishlist.id)
+        ).join(
+            product, 'LEFT', condition=(relation.product == product.id)
+        ).select(
+            relation.id,
+            where=(wishlist.id == Null) | (product.id == Null)
+        ))
+        violations['orphaned links'] = cursor.fetchall()
+    return dict((k, v) for k, v in violations.items() if v)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--products', type=int, default=50)
+    parser.add_argument(
+        '--requests', type=int, default=50, help='requests per user'
+    )
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument(
+        '--processes', type=int, default=0,
+        help='use a pool of processes instead of threads'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+
+    if DB_NAME == ':memory:':
+        parser.error(
+            'an in memory database can not be shared between workers, '
+            'set DB_NAME to a file or a PostgreSQL database'
+        )
+
+    emails, product_ids = setup_fixtures(options.users, options.products)
+
+    start = time.time()
+    if options.processes:
+        results = run_processes(
+            emails, product_ids, options.requests, options.processes,
+            options.seed
+        )
+    else:
+        results = run_threads(
+            emails, product_ids, options.requests, options.threads,
+            options.seed
+        )
+    elapsed = time.time() - start
+
+    latencies = sorted(
+        latency for result in results for latency in result[0]
+    )
+    errors = sum(result[1] for result in results)
+
+    print('requests:   %d (%d failed)' % (len(latencies), errors))
+    print('throughput: %.1f requests/s' % (len(latencies) / elapsed))
+    for fraction in (0.5, 0.9, 0.99):
+        print('p%-9d %.1f ms' % (
+            fraction * 100, percentile(latencies, fraction) * 1000
+        ))
+
+    violations = check_invariants()
+    for name, rows in sorted(violations.items()):
+        print('%s: %d' % (name, len(rows)))
+        for row in rows[:10]:
+            print('    %r' % (row,))
+    return 1 if violations or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_import_time.py
+
+    Benchmark of the import and the registration of the module.
+
+    The module is imported in a fresh interpreter, after its dependencies,
+    and the test fails if the fastest of a few runs goes over the budget
+    in seconds set by WISHLIST_IMPORT_BUDGET (default: 0.5).
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+#: Modules imported on first use only. Those already imported by the
+#: dependencies are not checked, as the module can not import them again.
+DEFERRED = [
+    'wtforms', 'nereid.contrib.locale', 'cProfile', 'pstats',
+]
+
+SCRIPT = '''
+import sys
+import json
+import time
+
+import trytond.modules
+import trytond.model
+import trytond.pool
+import nereid
+import flask
+
+before = set(sys.modules)
+start = time.time()
+from trytond.modules.nereid_wishlist import register
+register()
+elapsed = time.time() - start
+sys.stdout.write(json.dumps({
+    'elapsed': elapsed,
+    'preloaded': sorted(before),
+    'imported': sorted(set(sys.modules) - before),
+}))
+'''
+
+
+def measure():
+    """
+    Return the time taken to import and register the module in a fresh
+    interpreter, the modules imported before by its dependencies and the
+    modules this imported.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT], env=env
+    )
+    result = json.loads(output.decode('utf-8'))
+    return result['elapsed'], result['preloaded'], result['imported']
+
+
+class TestImportTime(unittest.TestCase):
+    '''
+    Test the import time of the module
+    '''
+
+    def test_0010_import_time(self):
+        '''
+        Import and registration stay within the budget
+        '''
+        budget = float(os.environ.get('WISHLIST_IMPORT_BUDGET', 0.5))
+        runs = [measure() for _ in range(3)]
+        elapsed = min(run[0] for run in runs)
+        self.assertLess(
+            elapsed, budget,
+            'import and register took %.3fs, budget %.3fs'
+            % (elapsed, budget)
+        )
+
+    def test_0020_deferred_imports(self):
+        '''
+        Translation, form and profiling machinery is not imported
+        '''
+        _, preloaded, imported = measure()
+        deferred = [name for name in DEFERRED if name not in preloaded]
+        # Only this module uses the profiler
+        self.assertIn('cProfile', deferred)
+        self.assertEqual(
+            [name for name in deferred if name in imported], []
+        )
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestImportTime)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -6,6 +6,12 @@
     :copyright: (c) 2014-2015 by Openlabs Technologies & Consulting (P) Ltd.
     :license: GPLv3, see LICENSE for more details
 '''
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
 import unittest
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
@@ -14,10 +20,18 @@ import datetime
 import pycountry
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond import backend
 from trytond.transaction import Transaction
 from nereid.testing import NereidTestCase
 from nereid import current_user
 
+from trytond.modules.nereid_wishlist.consistency import ConsistencyChecker
+from trytond.modules.nereid_wishlist.replica import read_replica, \
+    use_replica, SESSION_KEY
+from trytond.modules.nereid_wishlist.wishlist import MEMBERSHIP_KEY, \
+    _decode_ids
+from trytond.modules.nereid_wishlist.ratelimit import MemoryBackend
+
 
 class TestWishlist(NereidTestCase):
     "Test Wishlist"
@@ -44,9 +58,11 @@ class TestWishlist(NereidTestCase):
 
         self.templates = {
             'wishlists.jinja':
-                '{{ current_user.wishlists| length }}',
+                '{{ wishlists|length }}',
             'wishlist.jinja':
                 '{{ wishlist.name }}',
+            'wishlist-search.jinja':
+                '{{ wishlists|map(attribute="name")|join(",") }}',
         }
 
     def _create_payment_term(self):
@@ -690,6 +706,1249 @@ class TestWishlist(NereidTestCase):
                 wishlist = Wishlist(wishlist.id)    # reload the record
                 self.assertEqual(wishlist.name, 'Test2')
 
+    def test_0070_wishlist_etag(self):
+        """
+        Test conditional GET and If-Match on a wishlist
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post('/wishlists', data={'name': 'Test'})
+                wishlist = current_user.wishlists[0]
+
+                rv = c.get('/wishlists/%d' % wishlist.id)
+                self.assertEqual(rv.status_code, 200)
+                etag = rv.headers['ETag']
+
+                rv = c.get(
+                    '/wishlists/%d' % wishlist.id,
+                    headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 304)
+
+                # Stale version is rejected
+                rv = c.post(
+                    '/wishlists/%d' % wishlist.id,
+                    data={'name': 'Test2'},
+                    headers=[('If-Match', '"%d-0"' % wishlist.id)]
+                )
+                self.assertEqual(rv.status_code, 412)
+
+                rv = c.post(
+                    '/wishlists/%d' % wishlist.id,
+                    data={'name': 'Test2'},
+                    headers=[('If-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 302)
+
+                # The rename changed the version
+                rv = c.get(
+                    '/wishlists/%d' % wishlist.id,
+                    headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 200)
+                self.assertNotEqual(rv.headers['ETag'], etag)
+                etag = rv.headers['ETag']
+
+                # A change of a product changes the annotations
+                product, = self._create_products(1)
+                c.post('wishlists/products', data={
+                    'product': product.id,
+                    'action': 'add',
+                    'wishlist': wishlist.id,
+                })
+                rv = c.get('/wishlists/%d' % wishlist.id)
+                etag = rv.headers['ETag']
+                # As if changed by a later transaction
+                table = self.Template.__table__()
+                Transaction().cursor.execute(*table.update(
+                    columns=[table.write_date],
+                    values=[
+                        datetime.datetime.now()
+                        + datetime.timedelta(minutes=1)
+                    ],
+                    where=(table.id == product.template.id)
+                ))
+                rv = c.get(
+                    '/wishlists/%d' % wishlist.id,
+                    headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 200)
+
+                # Changes are only validated against the version
+                rv = c.post(
+                    '/wishlists/%d' % wishlist.id,
+                    data={'name': 'Test3'},
+                    headers=[('If-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 302)
+
+                # Other users see the public wishlist with their prices
+                c.post('/wishlists/%d' % wishlist.id, data={'public': '1'})
+                rv = c.get('/wishlists/%d' % wishlist.id)
+                etag = rv.headers['ETag']
+                self.login(c, 'email2@example.com', 'password2')
+                rv = c.get(
+                    '/wishlists/%d' % wishlist.id,
+                    headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 200)
+                self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def _create_products(self, count=2):
+        """
+        Create eshop products and return them
+        """
+        uom, = self.Uom.search([], limit=1)
+        templates = self.Template.create([{
+            'name': 'Product-%d' % i,
+            'type': 'goods',
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'default_uom': uom.id,
+            'products': [
+                ('create', [{
+                    'uri': 'product-%d' % i,
+                    'displayed_on_eshop': True
+                }])
+            ]
+        } for i in range(1, count + 1)])
+        return [template.products[0] for template in templates]
+
+    def test_0080_wishlist_count(self):
+        """
+        Test the wishlist count of products
+        """
+        Product = POOL.get('product.product')
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            product1, product2 = self._create_products()
+
+            Wishlist.create([{
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+                'products': [('add', [product1.id, product2.id])],
+            }, {
+                'name': 'Test',
+                'nereid_user': self.registered_user2.id,
+                'products': [('add', [product1.id])],
+            }])
+
+            self.assertEqual(Product(product1.id).wishlist_count, 2)
+            self.assertEqual(Product(product2.id).wishlist_count, 1)
+
+            self.assertEqual(
+                Product.search([('wishlist_count', '>', 1)]), [product1]
+            )
+            self.assertEqual(
+                Product.search([
+                    ('id', 'in', [product1.id, product2.id]),
+                ], order=[('wishlist_count', 'ASC')]),
+                [product2, product1]
+            )
+
+    def test_0090_wishlist_website(self):
+        """
+        Test that wishlists are scoped to the website of the request
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            website, = self.NereidWebsite.search([])
+            other_website, = self.NereidWebsite.copy([website], {
+                'name': 'other',
+            })
+
+            # Wishlist which belongs to another website
+            other, = Wishlist.create([{
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+                'website': other_website.id,
+            }])
+            # Wishlist which was not backfilled
+            legacy, = Wishlist.create([{
+                'name': 'Default',
+                'nereid_user': self.registered_user.id,
+            }])
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                rv = c.post('/wishlists', data={'name': 'Test'})
+                self.assertEqual(rv.status_code, 302)
+
+                wishlists = Wishlist.search([
+                    ('nereid_user', '=', self.registered_user.id),
+                ])
+                self.assertEqual(len(wishlists), 3)
+                wishlist, = Wishlist.search([
+                    ('nereid_user', '=', self.registered_user.id),
+                    ('website', '=', website.id),
+                ])
+                self.assertEqual(wishlist.name, 'Test')
+
+                rv = c.get('/wishlists/%d' % other.id)
+                self.assertEqual(rv.status_code, 404)
+
+                # Only the wishlists of the website are rendered
+                rv = c.get('/wishlists')
+                self.assertEqual(rv.data, '2')
+
+                # The wishlist without website is kept for its owner
+                rv = c.get('/wishlists/%d' % legacy.id)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(
+                    Wishlist._search_or_create_wishlist(), legacy
+                )
+
+    def test_0100_merge_duplicate_wishlist(self):
+        """
+        Test merging and duplicating wishlists
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            product1, product2 = self._create_products()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post('/wishlists', data={'name': 'Source'})
+                c.post('/wishlists', data={'name': 'Target'})
+                source, = Wishlist.search([('name', '=', 'Source')])
+                target, = Wishlist.search([('name', '=', 'Target')])
+                Wishlist.write([source], {
+                    'products': [('add', [product1.id, product2.id])],
+                })
+                Wishlist.write([target], {
+                    'products': [('add', [product1.id])],
+                })
+
+                rv = c.post(
+                    '/wishlists/%d/duplicate' % source.id,
+                    data={'name': 'Copy'}
+                )
+                self.assertEqual(rv.status_code, 302)
+                copy, = Wishlist.search([('name', '=', 'Copy')])
+                self.assertEqual(len(copy.products), 2)
+
+                rv = c.post(
+                    '/wishlists/%d/merge' % source.id,
+                    data={'target': target.id}
+                )
+                self.assertEqual(rv.status_code, 302)
+                self.assertFalse(Wishlist.search([('name', '=', 'Source')]))
+                target = Wishlist(target.id)
+                self.assertEqual(
+                    sorted(p.id for p in target.products),
+                    sorted([product1.id, product2.id])
+                )
+
+                # Merging into a wishlist of another user is not allowed
+                other, = Wishlist.create([{
+                    'name': 'Other',
+                    'nereid_user': self.registered_user2.id,
+                }])
+                rv = c.post(
+                    '/wishlists/%d/merge' % target.id,
+                    data={'target': other.id}
+                )
+                self.assertEqual(rv.status_code, 404)
+
+    def test_0110_wishlist_recommendations(self):
+        """
+        Test products wishlisted together are recommended
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+        Recommendation = POOL.get('product.wishlist.recommendation')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            product1, product2, product3 = self._create_products(3)
+
+            Wishlist.create([{
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+                'products': [('add', [product1.id, product2.id])],
+            }, {
+                'name': 'Test',
+                'nereid_user': self.registered_user2.id,
+                'products': [('add', [product1.id, product2.id])],
+            }])
+            Recommendation.refresh()
+
+            self.assertEqual(
+                product1.get_wishlist_recommendations(), [product2]
+            )
+            self.assertEqual(product3.get_wishlist_recommendations(), [])
+
+            # Incremental refresh picks up the new wishlist
+            other, = Wishlist.create([{
+                'name': 'Other',
+                'nereid_user': self.registered_user2.id,
+                'products': [('add', [product1.id, product3.id])],
+            }])
+            Recommendation.refresh()
+
+            self.assertEqual(
+                product1.get_wishlist_recommendations(), [product2, product3]
+            )
+            self.assertEqual(
+                product3.get_wishlist_recommendations(), [product1]
+            )
+
+            # And the product removed from it
+            Wishlist.write([other], {
+                'products': [('remove', [product3.id])],
+            })
+            Recommendation.refresh()
+
+            self.assertEqual(
+                product1.get_wishlist_recommendations(), [product2]
+            )
+            self.assertEqual(product3.get_wishlist_recommendations(), [])
+
+    def test_0120_profile_wishlist_routes(self):
+        """
+        Test that profiles are written only when requested
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                WISHLIST_PROFILE_DIR=directory,
+                WISHLIST_PROFILE_SECRET='s3cret',
+            )
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                rv = c.get('/wishlists')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(os.listdir(directory), [])
+
+                # The header is ignored without the secret
+                rv = c.get(
+                    '/wishlists', headers=[('X-Wishlist-Profile', '1')]
+                )
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(os.listdir(directory), [])
+
+                rv = c.get(
+                    '/wishlists', headers=[('X-Wishlist-Profile', 's3cret')]
+                )
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, '0')
+
+                files = sorted(os.listdir(directory))
+                self.assertEqual(len(files), 2)
+                self.assertTrue(files[0].endswith('.json'))
+                self.assertTrue(files[1].endswith('.prof'))
+                with open(os.path.join(directory, files[0])) as summary:
+                    phases = json.load(summary)['phases']
+                self.assertEqual(
+                    set(phases), set(['orm', 'sql', 'template', 'other'])
+                )
+
+    def test_0130_wishlist_metrics(self):
+        """
+        Test the metrics of the wishlist routes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            product, = self._create_products(1)
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post('wishlists/products', data={
+                    'product': product.id,
+                    'action': 'add',
+                })
+                c.post('wishlists/products', data={
+                    'product': product.id,
+                    'action': 'other',
+                })
+
+                # Denied by default, even from an address of the network
+                rv = c.get(
+                    '/wishlists/metrics',
+                    environ_base={'REMOTE_ADDR': '10.0.0.2'}
+                )
+                self.assertEqual(rv.status_code, 404)
+
+                app.config['WISHLIST_METRICS_ALLOWED'] = ('10.0.0.2',)
+                rv = c.get(
+                    '/wishlists/metrics',
+                    environ_base={'REMOTE_ADDR': '10.0.0.2'}
+                )
+                self.assertEqual(rv.status_code, 200)
+                self.assertIn(
+                    '# TYPE wishlist_requests_total counter', rv.data
+                )
+                self.assertIn(
+                    'wishlist_requests_total{action="add",'
+                    'route="wishlist.wishlist.wishlist_product",status="302"}',
+                    rv.data
+                )
+                self.assertIn(
+                    'wishlist_request_duration_seconds_bucket{action="add",'
+                    'le="+Inf",route="wishlist.wishlist.wishlist_product"}',
+                    rv.data
+                )
+                self.assertRegexpMatches(
+                    rv.data, r'wishlist_created_total \d+'
+                )
+                self.assertRegexpMatches(
+                    rv.data, r'wishlist_ineligible_product_total \d+'
+                )
+
+                rv = c.get(
+                    '/wishlists/metrics',
+                    environ_base={'REMOTE_ADDR': '10.0.0.1'}
+                )
+                self.assertEqual(rv.status_code, 404)
+
+                app.config['WISHLIST_METRICS_TOKEN'] = 's3cret'
+                rv = c.get(
+                    '/wishlists/metrics',
+                    environ_base={'REMOTE_ADDR': '10.0.0.1'},
+                    headers=[('Authorization', 'Bearer wrong')]
+                )
+                self.assertEqual(rv.status_code, 404)
+                rv = c.get(
+                    '/wishlists/metrics',
+                    environ_base={'REMOTE_ADDR': '10.0.0.1'},
+                    headers=[('Authorization', 'Bearer s3cret')]
+                )
+                self.assertEqual(rv.status_code, 200)
+
+    def test_0140_wishlist_history_undo(self):
+        """
+        Test restoring a deleted wishlist and undoing changes
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            product1, product2 = self._create_products()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                for product in (product1, product2):
+                    c.post('wishlists/products', data={
+                        'product': product.id,
+                        'action': 'add',
+                    })
+                wishlist, = current_user.wishlists
+                wishlist_id = wishlist.id
+
+                rv = c.delete('/wishlists/%d' % wishlist_id)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(len(current_user.wishlists), 0)
+
+                # Another user can not restore it
+                self.login(c, 'email2@example.com', 'password2')
+                rv = c.post('/wishlists/history/%d/undo' % wishlist_id)
+                self.assertEqual(rv.status_code, 404)
+
+                self.login(c, 'email@example.com', 'password')
+                rv = c.post('/wishlists/history/%d/undo' % wishlist_id)
+                self.assertEqual(rv.status_code, 302)
+                wishlist, = Wishlist.search([
+                    ('nereid_user', '=', self.registered_user.id),
+                ])
+                self.assertEqual(wishlist.name, 'Default')
+                self.assertEqual(len(wishlist.products), 2)
+
+                # The history follows the restored wishlist
+                rv = c.post('/wishlists/history/%d/undo' % wishlist.id)
+                self.assertEqual(rv.status_code, 302)
+                wishlist = Wishlist(wishlist.id)
+                self.assertEqual(wishlist.products, (product1,))
+
+    def test_0150_archive_stale_wishlists(self):
+        """
+        Test stale wishlists are archived and restored when the user is back
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+        WishlistArchive = POOL.get('wishlist.wishlist.archive')
+        NereidUser = POOL.get('nereid.user')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            website, = self.NereidWebsite.search([])
+            product1, product2 = self._create_products()
+
+            stale, recent = Wishlist.create([{
+                'name': 'Stale',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+                'public': True,
+                'products': [('add', [product1.id, product2.id])],
+            }, {
+                'name': 'Recent',
+                'nereid_user': self.registered_user2.id,
+                'website': website.id,
+            }])
+            # The user did not log in for long, the wishlists of the other
+            # user are kept even if they are not changed
+            table = NereidUser.__table__()
+            old = datetime.datetime.now() - datetime.timedelta(days=100)
+            Transaction().cursor.execute(*table.update(
+                columns=[table.wishlist_last_login],
+                values=[old],
+                where=(table.id == self.registered_user.id)
+            ))
+
+            self.assertEqual(
+                WishlistArchive.archive(age=30, commit=False),
+                {'wishlists': 1, 'links': 2}
+            )
+            self.assertEqual(Wishlist.search([]), [recent])
+            archive, = WishlistArchive.search([])
+            self.assertEqual(archive.name, 'Stale')
+            self.assertTrue(archive.public)
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                self.assertEqual(WishlistArchive.search([]), [])
+                restored = Wishlist(stale.id)
+                self.assertEqual(restored.name, 'Stale')
+                self.assertTrue(restored.public)
+                self.assertEqual(len(restored.products), 2)
+                self.assertGreater(
+                    NereidUser(self.registered_user.id).wishlist_last_login,
+                    old
+                )
+
+                # Later requests of the session do not look for archives
+                WishlistArchive.archive_rows([(
+                    stale.id, self.registered_user.id, website.id, 'Stale',
+                    True,
+                )])
+                rv = c.get('/wishlists')
+                self.assertEqual(rv.data, '0')
+
+            # Archives without a website are restored on every website
+            WishlistArchive.write(
+                WishlistArchive.search([]), {'website': None}
+            )
+            WishlistArchive.restore(self.registered_user.id, website.id)
+            self.assertEqual(WishlistArchive.search([]), [])
+            restored = Wishlist(stale.id)
+            self.assertEqual(restored.website, None)
+            self.assertEqual(len(restored.products), 2)
+
+    def test_0160_wishlist_badge(self):
+        """
+        Test the wishlist badge of the current user
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            product1, product2 = self._create_products()
+
+            with app.test_client() as c:
+                rv = c.get('/wishlists/badge')
+                self.assertEqual(
+                    json.loads(rv.data), {'wishlists': 0, 'items': 0}
+                )
+
+                self.login(c, 'email@example.com', 'password')
+                c.post('/wishlists', data={'name': 'Test'})
+                for product in (product1, product2):
+                    c.post('wishlists/products', data={
+                        'product': product.id,
+                        'action': 'add',
+                    })
+
+                rv = c.get('/wishlists/badge')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(
+                    json.loads(rv.data), {'wishlists': 2, 'items': 2}
+                )
+
+                # Changes of the user are visible at once
+                default, = [
+                    w for w in current_user.wishlists if w.name == 'Default'
+                ]
+                c.post('wishlists/products', data={
+                    'product': product1.id,
+                    'action': 'remove',
+                    'wishlist': default.id,
+                })
+                rv = c.get('/wishlists/badge')
+                self.assertEqual(json.loads(rv.data)['items'], 1)
+
+    def test_0170_search_public_wishlists(self):
+        """
+        Test searching public wishlists by name and owner
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            website, = self.NereidWebsite.search([])
+
+            wedding, birthday, private = Wishlist.create([{
+                'name': 'Wedding',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+                'public': True,
+            }, {
+                'name': 'Birthday',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+                'public': True,
+            }, {
+                'name': 'Secret',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+            }])
+
+            self.assertEqual(
+                Wishlist.search_public('wed', website.id), [wedding]
+            )
+            self.assertEqual(
+                Wishlist.search_public('EMAIL@example', website.id),
+                [wedding, birthday]
+            )
+            self.assertEqual(
+                Wishlist.search_public('registered user', website.id),
+                [wedding, birthday]
+            )
+            self.assertEqual(
+                Wishlist.search_public(
+                    'registered', website.id, after=wedding.id
+                ),
+                [birthday]
+            )
+            self.assertEqual(Wishlist.search_public('sec', website.id), [])
+            self.assertEqual(Wishlist.search_public('we', website.id), [])
+
+            with app.test_client() as c:
+                self.login(c, 'email2@example.com', 'password2')
+
+                rv = c.get('/wishlists/search?q=registered')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'Wedding,Birthday')
+
+                # Public wishlists can be viewed but not changed
+                rv = c.get('/wishlists/%d' % wedding.id)
+                self.assertEqual(rv.status_code, 200)
+                rv = c.post(
+                    '/wishlists/%d' % wedding.id, data={'name': 'Mine'}
+                )
+                self.assertEqual(rv.status_code, 404)
+                rv = c.get('/wishlists/%d' % private.id)
+                self.assertEqual(rv.status_code, 404)
+
+            # Wildcards in the query are matched literally
+            gifts, = Wishlist.create([{
+                'name': '100% Gifts',
+                'nereid_user': self.registered_user2.id,
+                'website': website.id,
+                'public': True,
+            }])
+            self.assertEqual(
+                Wishlist.search_public('100%', website.id), [gifts]
+            )
+            if backend.name() == 'postgresql':
+                # SQLite has no default escape character for LIKE
+                self.assertEqual(
+                    Wishlist.search_public('wed%', website.id), []
+                )
+                self.assertEqual(
+                    Wishlist.search_public('10_%', website.id), []
+                )
+
+    def test_0180_wishlist_item_annotations(self):
+        """
+        Test the price and availability of the products of a wishlist
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            product1, product2 = self._create_products()
+
+            wishlist, = Wishlist.create([{
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+                'products': [('add', [product1.id, product2.id])],
+            }])
+
+            with app.test_request_context('/'):
+                annotations = wishlist.get_item_annotations()
+
+            self.assertEqual(
+                set(annotations), set([product1.id, product2.id])
+            )
+            for annotation in annotations.values():
+                self.assertEqual(
+                    annotation['price'], Decimal('10') * self.guest_pl_margin
+                )
+                self.assertEqual(annotation['quantity'], 0)
+                self.assertFalse(annotation['available'])
+
+    def test_0190_consistency_checker(self):
+        """
+        Test finding and repairing inconsistent wishlist data
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+        WishlistArchive = POOL.get('wishlist.wishlist.archive')
+        Relation = POOL.get('product.wishlist-product')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            product1, product2 = self._create_products()
+
+            first, second, inactive = Wishlist.create([{
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+                'products': [('add', [product1.id, product2.id])],
+            }, {
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+            }, {
+                'name': 'Test',
+                'nereid_user': self.registered_user2.id,
+            }])
+            relation = Relation.__table__()
+            Transaction().cursor.execute(*relation.insert(
+                columns=[relation.wishlist, relation.product],
+                values=[[first.id, product1.id]]
+            ))
+            Product.write([product2], {'displayed_on_eshop': False})
+            self.NereidUser.write([self.registered_user2], {'active': False})
+
+            expected = {
+                'duplicate_links': 1,
+                'ineligible_links': 1,
+                'orphaned_links': 0,
+                'inactive_user_wishlists': 1,
+                'duplicate_wishlists': 1,
+            }
+            self.assertEqual(ConsistencyChecker(chunk_size=1).run(), expected)
+            self.assertEqual(
+                ConsistencyChecker(repair=True, commit=False).run(), expected
+            )
+
+            self.assertEqual(Wishlist.search([]), [first])
+            self.assertEqual(Wishlist(first.id).products, (product1,))
+            self.assertEqual(len(WishlistArchive.search([])), 1)
+            self.assertFalse(
+                any(ConsistencyChecker(commit=False).run().values())
+            )
+
+    def test_0200_digest(self):
+        """
+        Test queueing the wishlist digests and resuming an interrupted run
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+        Digest = POOL.get('wishlist.digest')
+        DigestRun = POOL.get('wishlist.digest.run')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            product1, product2 = self._create_products()
+
+            Wishlist.create([{
+                'name': 'Birthday',
+                'nereid_user': self.registered_user.id,
+                'products': [('add', [product1.id, product2.id])],
+            }, {
+                'name': 'Empty',
+                'nereid_user': self.registered_user2.id,
+            }])
+
+            # An interrupted run past the first user has nothing left to do
+            interrupted, = DigestRun.create([{
+                'last_user': self.registered_user.id,
+            }])
+            run = Digest.generate(chunk_size=1, commit=False)
+            self.assertEqual(run, interrupted)
+            self.assertEqual(DigestRun(run.id).state, 'done')
+            self.assertEqual(Digest.search([]), [])
+
+            run = Digest.generate(chunk_size=1, commit=False)
+            self.assertNotEqual(run, interrupted)
+            digest, = Digest.search([])
+            self.assertEqual(digest.nereid_user, self.registered_user)
+            self.assertEqual(digest.state, 'queued')
+            self.assertEqual(digest.to_address, self.registered_user.email)
+            self.assertEqual(digest.subject, 'Items in your wishlist')
+            self.assertIn('Birthday', digest.body)
+            self.assertIn(product1.template.name, digest.body)
+            self.assertIn(product2.template.name, digest.body)
+
+    def test_0210_read_replica(self):
+        """
+        Test routing the read only requests to the replica and pinning the
+        users who wrote to the primary
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        if backend.name() != 'sqlite':
+            self.skipTest('The replica is a copy of the sqlite database')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            product, = self._create_products(1)
+            website, = self.NereidWebsite.search([])
+            wishlist, = Wishlist.create([{
+                'name': 'Primary',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+            }])
+
+            # The replica holds a name the primary does not have
+            replica = self._copy_database()
+            connection = sqlite3.connect(replica + '.sqlite')
+            try:
+                connection.execute(
+                    'UPDATE "%s" SET name = ? WHERE id = ?' % Wishlist._table,
+                    ('Replica', wishlist.id)
+                )
+                connection.commit()
+            finally:
+                connection.close()
+            app = self.get_app(WISHLIST_REPLICA_DATABASE=replica)
+
+            with app.test_request_context('/wishlists', method='GET'):
+                self.assertTrue(use_replica())
+                primary = Transaction().cursor
+                with read_replica():
+                    self.assertIsNot(Transaction().cursor, primary)
+                    self.assertEqual(
+                        Transaction().cursor.database_name,
+                        primary.database_name
+                    )
+                self.assertIs(Transaction().cursor, primary)
+
+            with app.test_request_context('/wishlists', method='POST'):
+                self.assertFalse(use_replica())
+                primary = Transaction().cursor
+                with read_replica():
+                    self.assertIs(Transaction().cursor, primary)
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                rv = c.get('/wishlists/%d' % wishlist.id)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'Replica')
+
+                c.post('/wishlists/products', data={
+                    'product': product.id,
+                    'action': 'add',
+                    'wishlist': wishlist.id,
+                })
+                with c.session_transaction() as session:
+                    self.assertIn(SESSION_KEY, session)
+
+                # The user who wrote reads the primary
+                rv = c.get('/wishlists/%d' % wishlist.id)
+                self.assertEqual(rv.data, 'Primary')
+                rv = c.get('/wishlists/badge')
+                self.assertEqual(
+                    json.loads(rv.data), {'wishlists': 1, 'items': 1}
+                )
+
+            app = self.get_app()
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post('/wishlists/products', data={
+                    'product': product.id,
+                    'action': 'remove',
+                })
+                with c.session_transaction() as session:
+                    self.assertNotIn(SESSION_KEY, session)
+
+    def _copy_database(self):
+        """
+        Copy the sqlite test database, with the changes of the current
+        transaction, to a temporary file and return the name of the copy.
+
+        The name is an absolute path, so the backend does not look for it
+        in the database path.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        name = os.path.join(directory, 'replica')
+
+        connection = sqlite3.connect(name + '.sqlite')
+        try:
+            connection.executescript(
+                '\n'.join(Transaction().cursor._conn.iterdump())
+            )
+        finally:
+            connection.close()
+        return name
+
+    def test_0220_delta_sync(self):
+        """
+        Test syncing only the changes to the wishlists since a cursor
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            product1, product2 = self._create_products()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post('/wishlists/products', data={
+                    'product': product1.id,
+                    'action': 'add',
+                })
+                c.post('/wishlists', data={'name': 'Other'})
+
+                rv = c.get('/wishlists/sync')
+                changes = json.loads(rv.data)
+                default, other = changes['wishlists']
+                self.assertEqual(default['name'], 'Default')
+                self.assertEqual(other['name'], 'Other')
+                self.assertEqual(changes['items'], [{
+                    'wishlist': default['id'], 'product': product1.id,
+                }])
+                self.assertEqual(changes['removed_wishlists'], [])
+                self.assertEqual(changes['removed_items'], [])
+
+                rv = c.get('/wishlists/sync?cursor=%d' % changes['cursor'])
+                unchanged = json.loads(rv.data)
+                self.assertEqual(unchanged['cursor'], changes['cursor'])
+                self.assertEqual(unchanged['wishlists'], [])
+                self.assertEqual(unchanged['items'], [])
+
+                c.post('/wishlists/products', data={
+                    'product': product1.id,
+                    'action': 'remove',
+                })
+                c.post('/wishlists/products', data={
+                    'product': product2.id,
+                    'action': 'add',
+                })
+                c.delete('/wishlists/%d' % other['id'])
+
+                rv = c.get('/wishlists/sync?cursor=%d' % changes['cursor'])
+                delta = json.loads(rv.data)
+                self.assertGreater(delta['cursor'], changes['cursor'])
+                self.assertEqual(
+                    [w['id'] for w in delta['wishlists']], [default['id']]
+                )
+                self.assertEqual(delta['items'], [{
+                    'wishlist': default['id'], 'product': product2.id,
+                }])
+                self.assertEqual(delta['removed_wishlists'], [other['id']])
+                self.assertEqual(delta['removed_items'], [{
+                    'wishlist': default['id'], 'product': product1.id,
+                }])
+
+    def test_0230_session_membership(self):
+        """
+        Test answering whether products are wishlisted from the session
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            product1, product2 = self._create_products()
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                c.post('/wishlists/products', data={
+                    'product': product1.id,
+                    'action': 'add',
+                })
+                with c.session_transaction() as session:
+                    self.assertEqual(
+                        _decode_ids(session[MEMBERSHIP_KEY][1]),
+                        [product1.id]
+                    )
+
+                c.get('/wishlists')
+                self.assertTrue(Wishlist.is_wishlisted(product1))
+                self.assertTrue(Wishlist.is_wishlisted(product1.id))
+                self.assertFalse(Wishlist.is_wishlisted(product2))
+
+                # Changed outside of the session
+                default, = current_user.wishlists
+                Wishlist.write([default], {
+                    'products': [('add', [product2.id])],
+                })
+                c.get('/wishlists')
+                self.assertTrue(Wishlist.is_wishlisted(product2))
+
+                c.delete('/wishlists/%d' % default.id)
+                with c.session_transaction() as session:
+                    self.assertEqual(session[MEMBERSHIP_KEY][1], '')
+
+                c.get('/wishlists')
+                self.assertFalse(Wishlist.is_wishlisted(product1))
+
+    def test_0240_purge_removed_products(self):
+        """
+        Test hiding the links of delisted and deleted products and removing
+        them in batches
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+        Product = POOL.get('product.product')
+        Purge = POOL.get('product.wishlist.purge')
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            website, = self.NereidWebsite.search([])
+            product1, product2, product3 = self._create_products(3)
+
+            wishlist1, wishlist2 = Wishlist.create([{
+                'name': 'First',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+                'products': [('add', [product1.id, product2.id])],
+            }, {
+                'name': 'Second',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+                'products': [('add', [product1.id, product3.id])],
+            }])
+
+            Product.write([product1], {'displayed_on_eshop': False})
+            Product.delete([product2])
+
+            # The links are hidden before they are removed
+            self.assertEqual(len(Purge.search([])), 2)
+            self.assertEqual(Wishlist(wishlist1.id).products, ())
+            self.assertEqual(Wishlist(wishlist2.id).products, (product3,))
+            self.assertEqual(
+                Wishlist.get_wishlisted_ids(
+                    self.registered_user.id, website.id
+                ),
+                [product3.id]
+            )
+            self.assertEqual(
+                Wishlist.get_badge(self.registered_user.id, website.id),
+                {'wishlists': 2, 'items': 1}
+            )
+            self.assertTrue(Product.search([('id', '=', product2.id)]))
+
+            Purge.process(batch_size=1, pause=0, commit=False)
+
+            self.assertEqual(Purge.search([]), [])
+            self.assertEqual(Product(product1.id).wishlist_count, 0)
+            self.assertEqual(Product(product3.id).wishlist_count, 1)
+            self.assertEqual(Product.search([('id', '=', product2.id)]), [])
+
+            # A product which can not be deleted is dropped from the queue
+            supplier, = self.Location.search([('type', '=', 'supplier')])
+            Move.create([{
+                'product': product3.id,
+                'uom': product3.default_uom.id,
+                'quantity': 1,
+                'from_location': supplier.id,
+                'to_location': website.stock_location.id,
+                'company': self.company.id,
+                'unit_price': Decimal('5'),
+                'currency': self.company.currency.id,
+            }])
+            Product.delete([product3])
+            Purge.process(batch_size=1, pause=0, commit=False)
+
+            self.assertEqual(Purge.search([]), [])
+            product3 = Product(product3.id)
+            self.assertFalse(product3.displayed_on_eshop)
+            self.assertEqual(product3.wishlist_count, 0)
+
+    def test_0250_rate_limit(self):
+        """
+        Test limiting the wishlist writes with token buckets
+        """
+        backend = MemoryBackend()
+        self.assertEqual(backend.consume('key', 2, 1), 0)
+        self.assertEqual(backend.consume('key', 2, 1), 0)
+        self.assertGreater(backend.consume('key', 2, 1), 0)
+        self.assertEqual(backend.consume('other', 2, 1), 0)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            product, = self._create_products(1)
+            app = self.get_app(
+                WISHLIST_RATE_LIMIT=(2, 0.01),
+                WISHLIST_RATE_BACKEND=MemoryBackend(),
+            )
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                for action in ('add', 'remove'):
+                    rv = c.post('/wishlists/products', data={
+                        'product': product.id,
+                        'action': action,
+                    })
+                    self.assertEqual(rv.status_code, 302)
+
+                rv = c.post('/wishlists', data={'name': 'Test'})
+                self.assertEqual(rv.status_code, 429)
+                self.assertGreater(int(rv.headers['Retry-After']), 0)
+
+                # Reads are not limited
+                rv = c.get('/wishlists')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, '1')
+
+            # The users of an address share its own limit
+            app = self.get_app(
+                WISHLIST_RATE_LIMIT=(2, 0.01),
+                WISHLIST_RATE_LIMIT_IP=(3, 0.01),
+                WISHLIST_RATE_BACKEND=MemoryBackend(),
+            )
+            for email, password, statuses in [
+                    ('email@example.com', 'password', [302, 302]),
+                    ('email2@example.com', 'password2', [302, 429])]:
+                with app.test_client() as c:
+                    self.login(c, email, password)
+                    for action, status in zip(('add', 'remove'), statuses):
+                        rv = c.post('/wishlists/products', data={
+                            'product': product.id,
+                            'action': action,
+                        })
+                        self.assertEqual(rv.status_code, status)
+
+    def test_0260_cache_warm_up(self):
+        """
+        Test preloading the eligible products and the badges of recently
+        active users
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            website, = self.NereidWebsite.search([])
+            product1, product2 = self._create_products()
+            Wishlist.create([{
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+                'website': website.id,
+                'products': [('add', [product1.id, product2.id])],
+            }])
+            Product.write([product2], {'displayed_on_eshop': False})
+
+            deadline = time.time() + 10
+            self.assertEqual(
+                Product.preload_wishlist_eligible(10, deadline), 1
+            )
+            cache = Product._wishlist_eligible_cache
+            self.assertIs(cache.get(product1.id), True)
+            self.assertIs(cache.get(product2.id), None)
+            self.assertFalse(Product.is_wishlist_eligible(product2.id))
+            self.assertIs(cache.get(product2.id), False)
+
+            # Missing products are not cached
+            missing_id = product2.id + 1000
+            self.assertFalse(Product.is_wishlist_eligible(missing_id))
+            self.assertIs(cache.get(missing_id), None)
+
+            since = datetime.datetime.now() - datetime.timedelta(days=1)
+            self.assertEqual(
+                Wishlist.preload_badges(since, 10, deadline), 1
+            )
+            _, badge = Wishlist._badge_cache.get(
+                (self.registered_user.id, website.id)
+            )
+            self.assertEqual(badge, {'wishlists': 1, 'items': 1})
+
+            # Nothing is loaded past the deadline
+            self.assertEqual(
+                Product.preload_wishlist_eligible(10, time.time()), 0
+            )
+
+    def test_0270_history_maintenance(self):
+        """
+        Test the compaction and the purge of the wishlist history
+        """
+        Wishlist = POOL.get('wishlist.wishlist')
+        History = POOL.get('wishlist.wishlist.history')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            product1, product2, product3 = self._create_products(3)
+            table = History.__table__()
+            cursor = Transaction().cursor
+
+            def age(changes, days):
+                cursor.execute(*table.update(
+                    columns=[table.create_date],
+                    values=[
+                        datetime.datetime.now()
+                        - datetime.timedelta(days=days)
+                    ],
+                    where=table.id.in_([c.id for c in changes])
+                ))
+
+            wishlist, = Wishlist.create([{
+                'name': 'Test',
+                'nereid_user': self.registered_user.id,
+            }])
+            for action, product in [
+                    ('add', product1), ('add', product2),
+                    ('remove', product1), ('add', product3)]:
+                Wishlist.write([wishlist], {
+                    'products': [(action, [product.id])],
+                })
+            changes = History.search([('wishlist', '=', wishlist.id)])
+            self.assertEqual(len(changes), 4)
+
+            # Recent changes are kept as they are
+            History.compact(age=1)
+            self.assertEqual(
+                History.search([('wishlist', '=', wishlist.id)]), changes
+            )
+
+            # Older ones are replaced by their net change
+            age(changes, 2)
+            History.compact(age=1)
+            change, = History.search([('wishlist', '=', wishlist.id)])
+            self.assertEqual(change.action, 'add')
+            self.assertEqual(
+                _decode_ids(change.products),
+                sorted([product2.id, product3.id])
+            )
+
+            for product in (product2, product3):
+                Wishlist.write([wishlist], {
+                    'products': [('remove', [product.id])],
+                })
+            changes = History.search(
+                [('wishlist', '=', wishlist.id)], order=[('id', 'ASC')]
+            )
+            self.assertEqual(len(changes), 3)
+
+            # The changes past the retention are deleted chunk by chunk
+            age(changes[:2], 100)
+            History.purge(retention=90, chunk_size=1, commit=False)
+            self.assertEqual(
+                History.search([('wishlist', '=', wishlist.id)]),
+                changes[2:]
+            )
+
 
 def suite():
     "Nereid test suite"
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    warmup.py
+
+    Warm-up of the wishlist caches when a worker starts.
+
+    Warm-up is configured on the nereid application:
+
+    ``WISHLIST_WARMUP``
+        Warm up the caches on the first request of each worker
+        (default: False).
+    ``WISHLIST_WARMUP_SECONDS``
+        Time budget of the warm-up (default: 30).
+    ``WISHLIST_WARMUP_PRODUCTS``
+        Maximum number of eligible products cached (default: 50000).
+    ``WISHLIST_WARMUP_USERS``
+        Maximum number of badges cached (default: 5000).
+    ``WISHLIST_WARMUP_DAYS``
+        Badges are cached for the users whose wishlists changed in the last
+        days (default: 7).
+
+    The warm-up runs on a daemon thread with its own transaction, so the
+    request which starts it and the following ones are never blocked.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import logging
+import datetime
+import threading
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['warm_up', 'start_warm_up']
+
+logger = logging.getLogger(__name__)
+
+_started = set()
+_lock = threading.Lock()
+
+
+def warm_up(app):
+    """
+    Fill the wishlist caches of the database of the application within
+    the configured budget.
+
+    Return a tuple of the number of products and of badges cached.
+    """
+    config = app.config
+    start = time.time()
+    deadline = start + config.get('WISHLIST_WARMUP_SECONDS', 30)
+    since = datetime.datetime.now() - datetime.timedelta(
+        days=config.get('WISHLIST_WARMUP_DAYS', 7)
+    )
+
+    with Transaction().start(
+            config['DATABASE_NAME'], config.get('TRYTON_USER', 0),
+            context={}):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Wishlist = pool.get('wishlist.wishlist')
+
+        products = Product.preload_wishlist_eligible(
+            config.get('WISHLIST_WARMUP_PRODUCTS', 50000), deadline
+        )
+        badges = Wishlist.preload_badges(
+            since, config.get('WISHLIST_WARMUP_USERS', 5000), deadline,
+            ttl=config.get('WISHLIST_BADGE_TTL', 60)
+        )
+
+    logger.info(
+        'Warmed up %d wishlist eligible products and %d badges in %.1fs',
+        products, badges, time.time() - start
+    )
+    return products, badges
+
+
+def _run(app):
+    try:
+        warm_up(app)
+    except Exception:
+        logger.exception('Warm-up of the wishlist caches failed')
+
+
+def start_warm_up(app):
+    """
+    Start the warm-up of the application on a daemon thread, once per
+    process. Return the thread, or None if it was already started.
+    """
+    with _lock:
+        if id(app) in _started:
+            return None
+        _started.add(id(app))
+
+    thread = threading.Thread(
+        target=_run, args=(app,), name='wishlist-warmup'
+    )
+    thread.daemon = True
+    thread.start()
+    return thread
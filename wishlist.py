@@ -6,22 +6,107 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import time
+import heapq
+import hashlib
+import logging
+from bisect import bisect_left
+import datetime
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+
+from sql import Table, Null, Literal, Union
+from sql.aggregate import Count, Max, Min
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp, Lower
+from sql.operators import Like
+
+from trytond import backend
+from trytond.cache import Cache
 from trytond.pool import PoolMeta, Pool
 from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.tools import reduce_ids
 from nereid import login_required, current_user, request, \
-    redirect, url_for, render_template, route, abort, flash
-from nereid.contrib.locale import make_lazy_gettext
-from wtforms import ValidationError
+    redirect, url_for, render_template, route, abort, flash, \
+    current_app, jsonify, context_processor
+from nereid.signals import login
+from flask import has_request_context, session, g, request_started, \
+    make_response
+
+from profiling import profiled
+from metrics import registry, instrumented, may_read_metrics
+from replica import read_replica, replica_reads, rendered, pin_primary
+from ratelimit import rate_limited
+from warmup import start_warm_up
+
+_gettext = None
+
+
+def _(string, **variables):
+    """
+    Return the lazy translation of string. The locale machinery is
+    imported on the first translation and not with the module.
+    """
+    global _gettext
+    if _gettext is None:
+        from nereid.contrib.locale import make_lazy_gettext
+        _gettext = make_lazy_gettext('nereid-wishlist')
+    return _gettext(string, **variables)
 
-_ = make_lazy_gettext('nereid-wishlist')
 
+logger = logging.getLogger(__name__)
 
 __all__ = [
-    'NereidUser', 'Wishlist', 'Product',
-    'ProductWishlistRelationship',
+    'NereidUser', 'Wishlist', 'Product', 'Template',
+    'ProductWishlistRelationship', 'ProductWishlistPurge',
+    'ProductRecommendation',
+    'WishlistHistory', 'WishlistArchive', 'WishlistTombstone',
     ]
 __metaclass__ = PoolMeta
 
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+#: Session key of the wishlist sync sequence of the user and the encoded
+#: ids of their wishlisted products
+MEMBERSHIP_KEY = 'wishlist_products'
+
+#: Session key set once the archived wishlists of the user are restored
+RESTORED_KEY = 'wishlist_restored'
+
+
+def _encode_ids(ids):
+    """
+    Encode ids as the comma separated base 36 differences of the sorted
+    ids.
+    """
+    parts = []
+    previous = 0
+    for id_ in sorted(set(ids)):
+        delta, digits = id_ - previous, ''
+        while True:
+            delta, digit = divmod(delta, 36)
+            digits = _BASE36[digit] + digits
+            if not delta:
+                break
+        parts.append(digits)
+        previous = id_
+    return ','.join(parts)
+
+
+def _decode_ids(value):
+    """
+    Return the sorted list of ids encoded by _encode_ids.
+    """
+    ids = []
+    previous = 0
+    for part in value.split(',') if value else []:
+        previous += int(part, 36)
+        ids.append(previous)
+    return ids
+
 
 class Product:
     """
@@ -33,6 +118,223 @@ class Product:
         'product.wishlist-product',
         'product', 'wishlist', 'Wishlists'
     )
+    wishlist_count = fields.Function(
+        fields.Integer('Wishlist Count'), 'get_wishlist_count',
+        searcher='search_wishlist_count'
+    )
+
+    _wishlist_eligible_cache = Cache(
+        'product.product.wishlist_eligible', size_limit=100000, context=False
+    )
+
+    @classmethod
+    def is_wishlist_eligible(cls, product_id):
+        """
+        Return True if the product can be added to wishlists: it is
+        displayed on the eshop and its template is active.
+
+        Ids of missing products are not cached, as they may be created
+        later.
+        """
+        Template = Pool().get('product.template')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        template = Template.__table__()
+
+        if product_id is None:
+            return False
+        eligible = cls._wishlist_eligible_cache.get(product_id)
+        if eligible is None:
+            cursor.execute(*table.join(
+                template, condition=(table.template == template.id)
+            ).select(
+                table.displayed_on_eshop, template.active,
+                where=(table.id == product_id)
+            ))
+            row = cursor.fetchone()
+            if row is None:
+                return False
+            eligible = bool(row[0] and row[1])
+            cls._wishlist_eligible_cache.set(product_id, eligible)
+        return eligible
+
+    @classmethod
+    def preload_wishlist_eligible(cls, limit, deadline, chunk_size=1000):
+        """
+        Cache the eligibility of up to limit eligible products, reading
+        chunk_size ids at a time until the deadline (a time.time() value).
+
+        Return the number of products cached.
+        """
+        Template = Pool().get('product.template')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        template = Template.__table__()
+
+        limit = min(limit, cls._wishlist_eligible_cache.size_limit)
+        last_id, count = 0, 0
+        while count < limit and time.time() < deadline:
+            cursor.execute(*table.join(
+                template, condition=(table.template == template.id)
+            ).select(
+                table.id,
+                where=(table.id > last_id)
+                & (table.displayed_on_eshop == True)  # noqa
+                & (template.active == True),  # noqa
+                order_by=table.id.asc,
+                limit=min(chunk_size, limit - count)
+            ))
+            ids = [id_ for id_, in cursor.fetchall()]
+            if not ids:
+                break
+            for id_ in ids:
+                cls._wishlist_eligible_cache.set(id_, True)
+            last_id = ids[-1]
+            count += len(ids)
+        return count
+
+    @classmethod
+    def get_wishlist_count(cls, products, name):
+        """
+        Return the number of wishlists each product is in, counted with
+        one grouped query per chunk of products.
+        """
+        Relation = Pool().get('product.wishlist-product')
+        cursor = Transaction().cursor
+        relation = Relation.__table__()
+
+        ids = [p.id for p in products]
+        result = dict.fromkeys(ids, 0)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*relation.select(
+                relation.product, Count(relation.id),
+                where=reduce_ids(relation.product, sub_ids),
+                group_by=relation.product
+            ))
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def _wishlist_count_query(cls):
+        """
+        Return a query with the wishlist count of every product which is
+        in at least one wishlist.
+        """
+        Relation = Pool().get('product.wishlist-product')
+        relation = Relation.__table__()
+
+        return relation.select(
+            relation.product.as_('product'),
+            Count(relation.id).as_('wishlist_count'),
+            group_by=relation.product
+        )
+
+    @classmethod
+    def search_wishlist_count(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        table = cls.__table__()
+        counts = cls._wishlist_count_query()
+
+        query = table.join(
+            counts, 'LEFT', condition=(counts.product == table.id)
+        ).select(
+            table.id,
+            where=Operator(Coalesce(counts.wishlist_count, 0), value)
+        )
+        return [('id', 'in', query)]
+
+    @classmethod
+    def order_wishlist_count(cls, tables):
+        table, _ = tables[None]
+        if 'wishlist_count' not in tables:
+            counts = cls._wishlist_count_query()
+            tables['wishlist_count'] = {
+                None: (counts, counts.product == table.id),
+            }
+        counts, _ = tables['wishlist_count'][None]
+        return [Coalesce(counts.wishlist_count, 0)]
+
+    @classmethod
+    def write(cls, *args):
+        Purge = Pool().get('product.wishlist.purge')
+
+        actions = iter(args)
+        delisted = []
+        for products, values in zip(actions, actions):
+            if 'displayed_on_eshop' in values:
+                cls._wishlist_eligible_cache.clear()
+                if not values['displayed_on_eshop']:
+                    delisted.extend([p.id for p in products])
+        super(Product, cls).write(*args)
+        Purge.enqueue(delisted)
+
+    @classmethod
+    def delete(cls, products):
+        """
+        Products which are in wishlists are delisted and queued, and
+        deleted by the purge once their links are removed.
+        """
+        Purge = Pool().get('product.wishlist.purge')
+
+        linked = Purge.linked([p.id for p in products])
+        if linked:
+            cls.write(
+                [p for p in products if p.id in linked],
+                {'displayed_on_eshop': False}
+            )
+            Purge.enqueue(linked, delete=True)
+        super(Product, cls).delete(
+            [p for p in products if p.id not in linked]
+        )
+        cls._wishlist_eligible_cache.clear()
+
+    def get_wishlist_recommendations(self, limit=10):
+        """
+        Return the products most often wishlisted together with this
+        product, as computed by the last recommendation refresh.
+        """
+        Recommendation = Pool().get('product.wishlist.recommendation')
+
+        return [
+            r.recommended for r in Recommendation.search([
+                ('product', '=', self.id),
+            ], limit=limit)
+        ]
+
+
+class Template:
+    """
+    Extension of product template
+    """
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Purge = pool.get('product.wishlist.purge')
+
+        actions = iter(args)
+        delisted = []
+        for templates, values in zip(actions, actions):
+            if 'active' in values:
+                Product._wishlist_eligible_cache.clear()
+                if not values['active']:
+                    delisted.extend([
+                        p.id for t in templates for p in t.products
+                    ])
+        super(Template, cls).write(*args)
+        Purge.enqueue(delisted)
+
+    @classmethod
+    def delete(cls, templates):
+        Product = Pool().get('product.product')
+
+        super(Template, cls).delete(templates)
+        # The products are deleted with their template
+        Product._wishlist_eligible_cache.clear()
 
 
 class NereidUser:
@@ -44,6 +346,69 @@ class NereidUser:
     wishlists = fields.One2Many(
         'wishlist.wishlist', 'nereid_user', 'Wishlist'
     )
+    wishlist_sync = fields.Integer(
+        'Wishlist Sync', readonly=True,
+        help='The sync sequence of the last change to the wishlists'
+    )
+    wishlist_last_login = fields.DateTime(
+        'Wishlist Last Login', readonly=True,
+        help='The wishlists of users absent for long are archived'
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+
+        # Migration: existing users are absent from the upgrade on
+        backfill_login = not table.column_exist('wishlist_last_login')
+
+        super(NereidUser, cls).__register__(module_name)
+
+        if backfill_login:
+            sql_table = cls.__table__()
+            cursor.execute(*sql_table.update(
+                columns=[sql_table.wishlist_last_login],
+                values=[CurrentTimestamp()]
+            ))
+
+    @staticmethod
+    def default_wishlist_sync():
+        return 0
+
+    @classmethod
+    def _record_wishlist_login(cls, user_id):
+        """
+        Record that the user came back, which keeps their wishlists out of
+        the archive.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+            columns=[table.wishlist_last_login],
+            values=[CurrentTimestamp()],
+            where=(table.id == user_id)
+        ))
+
+    @classmethod
+    def _next_wishlist_sync(cls, user_ids):
+        """
+        Increment the wishlist sync sequence of the users, given as a list
+        or a query of ids.
+
+        The row lock taken on each user is held until the transaction ends,
+        so the changes of a user are committed in sequence order.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+            columns=[table.wishlist_sync],
+            values=[Coalesce(table.wishlist_sync, 0) + 1],
+            where=table.id.in_(user_ids)
+        ))
 
 
 class Wishlist(ModelSQL, ModelView):
@@ -60,164 +425,2314 @@ class Wishlist(ModelSQL, ModelView):
         'product.wishlist-product',
         'wishlist', 'product', 'Products',
     )
+    version = fields.Integer('Version', readonly=True, required=True)
+    sync_sequence = fields.Integer('Sync Sequence', readonly=True)
+    website = fields.Many2One('nereid.website', 'Website', select=True)
+    public = fields.Boolean(
+        'Public', help='Other users can find the wishlist by searching for '
+        'its name or the name or email of its owner'
+    )
+
+    _badge_cache = Cache('wishlist.wishlist.badge', context=False)
 
     @classmethod
-    def _search_or_create_wishlist(cls, name="Default"):
-        """
-        Search wishlist according to name.
-        if wishlist exist return wishlist, if not create a
-        new wishlist named Default and return that wishlist
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
 
-        return type: wishlist
-        """
-        try:
-            wishlist, = cls.search([
-                ('nereid_user', '=', current_user.id),
-                ('name', '=', name),
-            ])
-        except ValueError:
-            wishlist, = cls.create([{
-                'name': name,
-                'nereid_user': current_user.id,
-            }])
-        return wishlist
+        # Migration: wishlists were not scoped to a website
+        backfill_website = not table.column_exist('website')
+
+        super(Wishlist, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['website', 'nereid_user', 'name'], 'add')
+        table.index_action(['nereid_user', 'sync_sequence'], 'add')
+        cls._create_search_indexes()
+
+        if backfill_website:
+            cls._backfill_website()
 
     @classmethod
-    @route('/wishlists', methods=["GET", "POST"])
-    @login_required
-    def render_wishlists(cls):
+    def _create_search_indexes(cls):
         """
-        Render all wishlist of the current user.
-        if request is post and name is passed then call method
-        _search_or_create_wishlist.
+        Create the case insensitive indexes used by search_public on the
+        names of public wishlists and on the email and name of their
+        owners.
         """
-        if request.method == 'POST' and request.form.get("name"):
-            wishlist = cls._search_or_create_wishlist(request.form.get("name"))
-            if request.is_xhr:
-                # TODO: send all wishlist as serialized data
-                return 'success', 200
-            return redirect(
-                url_for(
-                    'wishlist.wishlist.render_wishlist', active_id=wishlist.id
-                )
+        pool = Pool()
+        NereidUser = pool.get('nereid.user')
+        Party = pool.get('party.party')
+        cursor = Transaction().cursor
+
+        postgresql = backend.name() == 'postgresql'
+        pg_indexes = Table('pg_indexes')
+
+        # Prefix matching with LIKE uses the index in any locale only with
+        # the pattern operator class
+        opclass = ' text_pattern_ops' if postgresql else ''
+        for table, column, where in [
+                (cls._table, 'name', ' WHERE public'),
+                (NereidUser._table, 'email', ''),
+                (Party._table, 'name', ''),
+                ]:
+            index = '%s_lower_%s_wishlist_index' % (table, column)
+            if postgresql:
+                # IF NOT EXISTS is only supported since PostgreSQL 9.5
+                cursor.execute(*pg_indexes.select(
+                    pg_indexes.indexname,
+                    where=(pg_indexes.indexname == index)
+                ))
+                if cursor.fetchone():
+                    continue
+                exists = ''
+            else:
+                exists = 'IF NOT EXISTS '
+            cursor.execute(
+                'CREATE INDEX %s"%s" ON "%s" (LOWER("%s")%s)%s'
+                % (exists, index, table, column, opclass, where)
             )
-        return render_template('wishlists.jinja')
 
-    @route(
-        '/wishlists/<int:active_id>',
-        methods=["POST", "GET", "DELETE"]
-    )
-    @login_required
-    def render_wishlist(self):
+    @classmethod
+    def _backfill_website(cls, batch_size=1000):
         """
-        Render specific wishlist of current user.
-        rename wishlist on post  and delete on delete request
+        Set the website of existing wishlists to the first website of the
+        company of their user. Rows are walked in id order, batch_size at a
+        time, so that no statement touches the whole table.
         """
-        Wishlist = Pool().get('wishlist.wishlist')
+        pool = Pool()
+        Website = pool.get('nereid.website')
+        NereidUser = pool.get('nereid.user')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        website = Website.__table__()
+        user = NereidUser.__table__()
 
-        if self.nereid_user != current_user:
-            abort(404)
+        cursor.execute(*website.select(
+            website.company, Min(website.id),
+            group_by=website.company
+        ))
+        company_websites = dict(cursor.fetchall())
+        if not company_websites:
+            return
 
-        if request.method == "POST" and request.form.get('name'):
+        last_id = 0
+        while True:
+            cursor.execute(*table.join(
+                user, condition=(table.nereid_user == user.id)
+            ).select(
+                table.id, user.company,
+                where=(table.id > last_id) & (table.website == Null),
+                order_by=table.id.asc,
+                limit=batch_size
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
 
-            name = request.form.get('name')
-            wishlist = Wishlist.search([
-                ('nereid_user', '=', current_user.id),
-                ('name', '=', name),
-            ], limit=1)
-            if wishlist:
-                flash(
-                    _(
-                        'Wishlist with name: %(name)s already exists.',
-                        name=name
+            ids_by_website = defaultdict(list)
+            for wishlist_id, company in rows:
+                if company in company_websites:
+                    ids_by_website[company_websites[company]].append(
+                        wishlist_id
                     )
-                )
-                return redirect(request.referrer)
+            for website_id, ids in ids_by_website.items():
+                cursor.execute(*table.update(
+                    columns=[table.website],
+                    values=[website_id],
+                    where=reduce_ids(table.id, ids)
+                ))
 
-            else:
-                self.name = name
-                self.save()
-                flash(_('Changed name of wishlist to %(name)s.', name=name))
-            if request.is_xhr:
-                return 'success', 200
+    @staticmethod
+    def default_version():
+        return 1
 
-            return redirect(request.referrer)
+    @classmethod
+    def _website_domain(cls):
+        """
+        Return the domain restricting wishlists to the website of the
+        current request. Wishlists without a website, which could not be
+        backfilled, belong to every website.
+        """
+        return [[
+            'OR',
+            ('website', '=', request.nereid_website.id),
+            ('website', '=', None),
+        ]]
 
-        elif request.method == "DELETE":
-            Wishlist.delete([self])
-            if request.is_xhr:
-                # TODO: send serialized data of current wishlist
-                return 'success', 200
+    @staticmethod
+    def _website_where(table, website):
+        """
+        Return the SQL condition of _website_domain on table for website.
+        """
+        return (table.website == website) | (table.website == Null)
 
-            return url_for('wishlist.wishlist.render_wishlists')
+    def _on_website(self):
+        """
+        Return True if the wishlist belongs to the website of the current
+        request.
+        """
+        return self.website in (None, request.nereid_website)
+
+    @classmethod
+    def write(cls, *args):
+        History = Pool().get('wishlist.wishlist.history')
+
+        actions = iter(args)
+        ids = []
+        renamed = []
+        for records, values in zip(actions, actions):
+            ids.extend([r.id for r in records])
+            if 'name' in values:
+                renamed.extend([
+                    r for r in records if r.name != values['name']
+                ])
+        History.log_rename(renamed)
 
-        return render_template('wishlist.jinja', wishlist=self)
+        super(Wishlist, cls).write(*args)
+        cls._bump_version(ids)
 
     @classmethod
-    @route('/wishlists/products', methods=["POST"])
-    @login_required
-    def wishlist_product(cls):
+    def create(cls, vlist):
+        wishlists = super(Wishlist, cls).create(vlist)
+        cls._bump_version([w.id for w in wishlists], version=False)
+        return wishlists
+
+    @classmethod
+    def delete(cls, wishlists):
+        pool = Pool()
+        History = pool.get('wishlist.wishlist.history')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+
+        # The deletion records the products of the wishlists, so the links
+        # deleted by the cascade do not record their own removal
+        ids = [w.id for w in wishlists]
+        History.log('delete', cls._get_product_ids(ids))
+        Tombstone.bury(dict.fromkeys(ids))
+        with Transaction().set_context(_wishlist_deleted=ids):
+            super(Wishlist, cls).delete(wishlists)
+        cls._wishlists_changed()
+
+    @classmethod
+    def _get_product_ids(cls, ids):
         """
-        Add/Remove product in wishlist.
-        If wishlist_id is passed then search for wishlist and add/remove
-        product else create a default wishlist and add product.
+        Return a dictionary of the product ids of each wishlist.
+        """
+        Relation = Pool().get('product.wishlist-product')
+        cursor = Transaction().cursor
+        relation = Relation.__table__()
 
-        :params
-            wishlist: Get the id of wishlist
-            product: Get product id
-            action: add or remove, add will add product to wishlist.
-                remove will unlink product from wishlist
+        result = dict((id_, []) for id_ in ids)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*relation.select(
+                relation.wishlist, relation.product,
+                where=reduce_ids(relation.wishlist, sub_ids)
+            ))
+            for wishlist_id, product_id in cursor.fetchall():
+                result[wishlist_id].append(product_id)
+        return result
+
+    @classmethod
+    def _bump_version(cls, ids, version=True):
         """
-        Product = Pool().get('product.product')
+        Increment the version of the given wishlists, unless version is
+        False, and move them to the next sync sequence of their users.
 
-        wishlist_id = request.form.get("wishlist", type=int)
-        if wishlist_id:
-            try:
-                wishlist, = cls.search([
-                    ('id', '=', wishlist_id),
-                    ('nereid_user', '=', current_user.id),
-                ])
-            except ValueError:
-                raise ValidationError("Wishlist not valid!")
-        else:
-            wishlist = cls._search_or_create_wishlist()
-        product = Product.search([
-            ('id', '=', request.form.get("product", type=int)),
-            ('displayed_on_eshop', '=', True),
-            ('template.active', '=', True),
-        ], limit=1)
-        if not product or request.form.get('action') not in ['add', 'remove']:
-            abort(404)
-        cls.write([wishlist], {
-            'products': [(request.form.get('action'), product)],
-        })
-        if request.is_xhr:
-            # TODO: Send serailized data of wishllist
-            return 'success', 200
+        The update is done in SQL (not through write) so that it can be
+        called from the relationship model without recursing.
+        """
+        NereidUser = Pool().get('nereid.user')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        user = NereidUser.__table__()
 
-        return redirect(
-            url_for(
-                'wishlist.wishlist.render_wishlist',
-                active_id=wishlist.id
+        ids = list(set(ids))
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            NereidUser._next_wishlist_sync(table.select(
+                table.nereid_user, where=reduce_ids(table.id, sub_ids)
+            ))
+            columns = [table.sync_sequence, table.write_date]
+            values = [
+                user.select(
+                    user.wishlist_sync,
+                    where=(user.id == table.nereid_user)
+                ),
+                CurrentTimestamp(),
+            ]
+            if version:
+                columns.append(table.version)
+                values.append(table.version + 1)
+            cursor.execute(*table.update(
+                columns=columns, values=values,
+                where=reduce_ids(table.id, sub_ids)
+            ))
+        cls._wishlists_changed()
+
+    @classmethod
+    def _wishlists_changed(cls):
+        """
+        Forget what the current request knows of the wishlists of its user,
+        which are the ones being changed: the cached badge, of which other
+        workers keep theirs until it expires, and the wishlisted products
+        kept in the session. The user is also pinned to the primary
+        database to read their own writes.
+        """
+        if has_request_context():
+            cls._badge_cache.set(
+                (current_user.id, request.nereid_website.id), None
             )
-        )
+            session.pop(MEMBERSHIP_KEY, None)
+            pin_primary()
 
+    @classmethod
+    def get_badge(cls, nereid_user, website):
+        """
+        Return a dictionary with the number of wishlists of the user on the
+        website and the number of products in them.
 
-class ProductWishlistRelationship(ModelSQL):
-    """
-    This is the relation between wishlist and a product.
-    """
-    __name__ = 'product.wishlist-product'
+        The counts are computed with one aggregate query and cached for
+        WISHLIST_BADGE_TTL seconds (default: 60).
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Purge = pool.get('product.wishlist.purge')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        relation = Relation.__table__()
 
-    product = fields.Many2One(
-        'product.product', 'Product',
-        domain=[
-            ('displayed_on_eshop', '=', True),
-            ('template.active', '=', True),
-        ],
-        ondelete='CASCADE', select=True, required=True,
-    )
-    wishlist = fields.Many2One(
-        'wishlist.wishlist', 'Wishlist',
-        ondelete='CASCADE', select=True, required=True
-    )
+        key = (nereid_user, website)
+        cached = cls._badge_cache.get(key)
+        if cached is not None:
+            expire, badge = cached
+            if expire > time.time():
+                return badge
+
+        cursor.execute(*table.join(
+            relation, 'LEFT', condition=(relation.wishlist == table.id)
+            & Purge.visible(relation.product)
+        ).select(
+            Count(table.id, distinct=True), Count(relation.id),
+            where=(table.nereid_user == nereid_user)
+            & cls._website_where(table, website)
+        ))
+        wishlists, items = cursor.fetchone()
+        badge = {'wishlists': wishlists, 'items': items}
+
+        ttl = current_app.config.get('WISHLIST_BADGE_TTL', 60) \
+            if has_request_context() else 60
+        cls._badge_cache.set(key, (time.time() + ttl, badge))
+        return badge
+
+    @classmethod
+    @context_processor('wishlist_badge')
+    def get_current_badge(cls):
+        """
+        Return the wishlist badge of the current user, or empty counts for
+        guests. Available in templates as wishlist_badge().
+        """
+        if current_user.is_anonymous():
+            return {'wishlists': 0, 'items': 0}
+        return cls.get_badge(current_user.id, request.nereid_website.id)
+
+    @classmethod
+    def preload_badges(cls, since, limit, deadline, ttl=60):
+        """
+        Cache for ttl seconds the badges of the up to limit users whose
+        wishlists changed after since, most recent first, with one
+        aggregate query per chunk of users until the deadline (a time.time()
+        value).
+
+        Return the number of badges cached.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Purge = pool.get('product.wishlist.purge')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        relation = Relation.__table__()
+
+        # The badges of the users with wishlists without website count
+        # them on every website, they are left to get_badge
+        legacy = cls.__table__()
+        changed = Coalesce(table.write_date, table.create_date)
+        cursor.execute(*table.select(
+            table.nereid_user,
+            where=(changed >= since)
+            & ~table.nereid_user.in_(legacy.select(
+                legacy.nereid_user, where=(legacy.website == Null)
+            )),
+            group_by=table.nereid_user,
+            order_by=Max(changed).desc,
+            limit=limit
+        ))
+        user_ids = [user_id for user_id, in cursor.fetchall()]
+
+        count = 0
+        for i in range(0, len(user_ids), cursor.IN_MAX):
+            if time.time() >= deadline:
+                break
+            sub_ids = user_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.join(
+                relation, 'LEFT', condition=(relation.wishlist == table.id)
+                & Purge.visible(relation.product)
+            ).select(
+                table.nereid_user, table.website,
+                Count(table.id, distinct=True), Count(relation.id),
+                where=reduce_ids(table.nereid_user, sub_ids)
+                & (table.website != Null),
+                group_by=[table.nereid_user, table.website]
+            ))
+            expire = time.time() + ttl
+            for user_id, website_id, wishlists, items in cursor.fetchall():
+                cls._badge_cache.set((user_id, website_id), (expire, {
+                    'wishlists': wishlists, 'items': items,
+                }))
+                count += 1
+        return count
+
+    @classmethod
+    def get_wishlisted_ids(cls, nereid_user, website):
+        """
+        Return the sorted ids of the products in the wishlists of the user
+        on the website.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Purge = pool.get('product.wishlist.purge')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        relation = Relation.__table__()
+
+        cursor.execute(*relation.join(
+            table, condition=(relation.wishlist == table.id)
+        ).select(
+            relation.product,
+            where=(table.nereid_user == nereid_user)
+            & cls._website_where(table, website)
+            & Purge.visible(relation.product),
+            distinct=True,
+            order_by=relation.product.asc
+        ))
+        return [product_id for product_id, in cursor.fetchall()]
+
+    @classmethod
+    def _refresh_membership(cls):
+        """
+        Store the ids of the products wishlisted by the current user in the
+        session, encoded with _encode_ids, with the wishlist sync sequence
+        of the user they match. Return the stored value.
+        """
+        NereidUser = Pool().get('nereid.user')
+        cursor = Transaction().cursor
+        user = NereidUser.__table__()
+
+        cursor.execute(*user.select(
+            Coalesce(user.wishlist_sync, 0),
+            where=(user.id == current_user.id)
+        ))
+        sequence, = cursor.fetchone()
+        membership = session[MEMBERSHIP_KEY] = [
+            sequence, _encode_ids(cls.get_wishlisted_ids(
+                current_user.id, request.nereid_website.id
+            )),
+        ]
+        return membership
+
+    @classmethod
+    @context_processor('is_wishlisted')
+    def is_wishlisted(cls, product):
+        """
+        Return True if the product, or product id, is in a wishlist of the
+        current user. Available in templates as is_wishlisted(product).
+
+        The ids are read from the session and decoded once per request, so
+        listing pages need no database access. They are read again when
+        the sync sequence of the user moved, as the wishlists were changed
+        by another session or outside of a request.
+        """
+        if current_user.is_anonymous():
+            return False
+        membership = session.get(MEMBERSHIP_KEY)
+        if not getattr(g, 'wishlist_sync_checked', False):
+            if membership and \
+                    membership[0] != (current_user.wishlist_sync or 0):
+                membership = None
+            g.wishlist_sync_checked = True
+        if not membership:
+            membership = cls._refresh_membership()
+        encoded = membership[1]
+        if getattr(g, 'wishlisted', (None,))[0] != encoded:
+            g.wishlisted = (encoded, _decode_ids(encoded))
+        ids = g.wishlisted[1]
+
+        product_id = getattr(product, 'id', product)
+        index = bisect_left(ids, product_id)
+        return index < len(ids) and ids[index] == product_id
+
+    def get_item_annotations(self):
+        """
+        Return a dictionary with the sale price, the quantity in stock and
+        the availability of each product of the wishlist::
+
+            {product_id: {'price': .., 'quantity': .., 'available': ..}}
+
+        The prices of all the products are computed in one call with the
+        price list and the customer used by nereid_cart_b2c, and the
+        quantities with one grouped stock query on the location of the
+        website.
+        """
+        Product = Pool().get('product.product')
+
+        products = list(self.products)
+        if not products:
+            return {}
+
+        website = request.nereid_website
+        with Transaction().set_context(self._get_price_context()):
+            prices = Product.get_sale_price(products, 0)
+
+        product_ids = [p.id for p in products]
+        location = website.stock_location
+        with Transaction().set_context(locations=[location.id]):
+            quantities = Product.products_by_location(
+                [location.id], product_ids, with_childs=True
+            )
+
+        annotations = {}
+        for product in products:
+            quantity = quantities.get((location.id, product.id), 0)
+            annotations[product.id] = {
+                'price': prices[product.id],
+                'quantity': quantity,
+                'available': product.type == 'service' or quantity > 0,
+            }
+        return annotations
+
+    @staticmethod
+    def _get_price_context():
+        """
+        Return the context of the prices of the item annotations for the
+        current user.
+        """
+        Sale = Pool().get('sale.sale')
+
+        if current_user.is_anonymous():
+            customer = request.nereid_website.guest_user.party
+        else:
+            customer = current_user.party
+        return {
+            'customer': customer.id,
+            'price_list': Sale.default_price_list(),
+            'currency': request.nereid_currency.id,
+        }
+
+    def _get_annotation_changes(self):
+        """
+        Return the last change of the products of the wishlist and the last
+        change of their stock moves, on which the item annotations depend.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Move = pool.get('stock.move')
+        cursor = Transaction().cursor
+        relation = Relation.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        move = Move.__table__()
+
+        products = relation.select(
+            relation.product, where=(relation.wishlist == self.id)
+        )
+        cursor.execute(*product.join(
+            template, condition=(product.template == template.id)
+        ).select(
+            Max(Coalesce(product.write_date, product.create_date)),
+            Max(Coalesce(template.write_date, template.create_date)),
+            where=product.id.in_(products)
+        ))
+        changes = cursor.fetchone()
+        cursor.execute(*move.select(
+            Max(Coalesce(move.write_date, move.create_date)),
+            where=move.product.in_(products)
+        ))
+        return changes + cursor.fetchone()
+
+    def get_version_tag(self):
+        """
+        Return the tag of the version of the wishlist, the validator of
+        the If-Match header of changes.
+
+        The version is read straight from the table because it is bumped
+        in SQL and the record may hold a stale value.
+        """
+        cursor = Transaction().cursor
+        table = self.__table__()
+
+        cursor.execute(*table.select(
+            table.version, where=(table.id == self.id)
+        ))
+        version, = cursor.fetchone()
+        return '%d-%d' % (self.id, version)
+
+    def get_etag(self):
+        """
+        Return the entity tag of the wishlist as rendered for the current
+        user.
+
+        It extends the version tag with the state of the item annotations:
+        the price context of the user, as public wishlists are shared, and
+        the last change of the products and of their stock.
+        """
+        context = self._get_price_context()
+        state = repr((
+            sorted(context.items()), self._get_annotation_changes()
+        ))
+        return '%s-%s' % (
+            self.get_version_tag(),
+            hashlib.sha1(state.encode('utf-8')).hexdigest()[:16],
+        )
+
+    def matches_version(self, etags):
+        """
+        Return True if the entity tags of an If-Match header match the
+        current version, whatever the state of the annotations of the
+        rendered wishlist was.
+        """
+        if etags.star_tag:
+            return True
+        tag = self.get_version_tag()
+        return any(
+            t == tag or t.startswith(tag + '-') for t in etags.as_set()
+        )
+
+    @classmethod
+    def _copy_products(cls, source_ids, target_id):
+        """
+        Link the products of the source wishlists to the target wishlist
+        with a single INSERT ... SELECT, skipping products which are
+        already in the target.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        History = pool.get('wishlist.wishlist.history')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        relation = Relation.__table__()
+        existing = Relation.__table__()
+
+        where = reduce_ids(relation.wishlist, source_ids) \
+            & ~relation.product.in_(existing.select(
+                existing.product,
+                where=(existing.wishlist == target_id)
+            ))
+        cursor.execute(*relation.select(
+            relation.product, where=where, distinct=True
+        ))
+        History.log('add', {
+            target_id: [product_id for product_id, in cursor.fetchall()],
+        })
+
+        cursor.execute(*relation.insert(
+            columns=[
+                relation.create_uid, relation.create_date,
+                relation.wishlist, relation.product,
+            ],
+            values=relation.select(
+                Literal(transaction.user), CurrentTimestamp(),
+                Literal(target_id), relation.product,
+                where=where, distinct=True
+            )
+        ))
+        cls._bump_version([target_id])
+        Relation._sync_links([target_id])
+
+    @classmethod
+    def _link_products(cls, target_id, product_ids):
+        """
+        Link the eligible products among product_ids to the target wishlist
+        with a single INSERT ... SELECT, skipping products which are
+        already in the target.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        relation = Relation.__table__()
+        existing = Relation.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*relation.insert(
+                columns=[
+                    relation.create_uid, relation.create_date,
+                    relation.wishlist, relation.product,
+                ],
+                values=product.join(
+                    template, condition=(product.template == template.id)
+                ).select(
+                    Literal(transaction.user), CurrentTimestamp(),
+                    Literal(target_id), product.id,
+                    where=reduce_ids(product.id, sub_ids)
+                    & (product.displayed_on_eshop == True)  # noqa
+                    & (template.active == True)  # noqa
+                    & ~product.id.in_(existing.select(
+                        existing.product,
+                        where=(existing.wishlist == target_id)
+                    ))
+                )
+            ))
+        cls._bump_version([target_id])
+        Relation._sync_links([target_id])
+
+    @classmethod
+    def merge(cls, source, target):
+        """
+        Move the products of the source wishlist into the target wishlist
+        and delete the source.
+        """
+        cls._copy_products([source.id], target.id)
+        cls.delete([source])
+
+    @classmethod
+    def duplicate(cls, wishlist, name):
+        """
+        Create a copy of the wishlist with the given name and return it.
+        """
+        new_wishlist, = cls.create([{
+            'name': name,
+            'nereid_user': wishlist.nereid_user.id,
+            'website': wishlist.website and wishlist.website.id,
+        }])
+        cls._copy_products([wishlist.id], new_wishlist.id)
+        return new_wishlist
+
+    @staticmethod
+    def default_public():
+        return False
+
+    @classmethod
+    def search_public(cls, query, website, after=0, limit=20):
+        """
+        Return the public wishlists of the website after the id after,
+        whose name or owner name or owner email starts with query, case
+        insensitively.
+
+        Each criterion is matched by its own indexed query and the results
+        are combined with UNION, so that every lookup uses an index.
+        """
+        pool = Pool()
+        NereidUser = pool.get('nereid.user')
+        Party = pool.get('party.party')
+        cursor = Transaction().cursor
+
+        query = query.strip().lower()
+        if len(query) < 3:
+            return []
+        # The wildcards of the query are matched literally where LIKE
+        # escapes with a backslash by default
+        pattern = query
+        if backend.name() == 'postgresql':
+            pattern = pattern.replace('\\', '\\\\').replace('%', '\\%') \
+                .replace('_', '\\_')
+        pattern += '%'
+
+        def public(wishlist):
+            return (
+                (wishlist.public == True)  # noqa
+                & (wishlist.website == website)
+                & (wishlist.id > after)
+            )
+
+        def starts(column):
+            return Like(Lower(column), pattern)
+
+        by_name = cls.__table__()
+        by_email = cls.__table__()
+        by_owner = cls.__table__()
+        user = NereidUser.__table__()
+        owner = NereidUser.__table__()
+        party = Party.__table__()
+
+        union = Union(
+            by_name.select(
+                by_name.id.as_('id'),
+                where=public(by_name) & starts(by_name.name)
+            ),
+            user.join(
+                by_email, condition=(by_email.nereid_user == user.id)
+            ).select(
+                by_email.id.as_('id'),
+                where=public(by_email) & starts(user.email)
+            ),
+            party.join(
+                owner, condition=(owner.party == party.id)
+            ).join(
+                by_owner, condition=(by_owner.nereid_user == owner.id)
+            ).select(
+                by_owner.id.as_('id'),
+                where=public(by_owner) & starts(party.name)
+            ),
+        )
+        cursor.execute(*union.select(
+            union.id, order_by=union.id.asc, limit=limit
+        ))
+        return cls.browse([id_ for id_, in cursor.fetchall()])
+
+    @classmethod
+    @route('/wishlists/search', methods=["GET"])
+    @login_required
+    @replica_reads
+    def render_search(cls):
+        """
+        Search public wishlists by their name or the name or email of
+        their owner.
+
+        :params
+            q: Get the text the searched names start with
+            after: Get the id of the last wishlist of the previous page
+        """
+        per_page = 20
+        wishlists = cls.search_public(
+            request.args.get('q', ''), request.nereid_website.id,
+            after=request.args.get('after', 0, type=int), limit=per_page
+        )
+        after = wishlists[-1].id if len(wishlists) == per_page else None
+
+        if request.is_xhr:
+            return jsonify(
+                wishlists=[{
+                    'id': w.id,
+                    'name': w.name,
+                    'owner': w.nereid_user.display_name,
+                } for w in wishlists],
+                after=after,
+            )
+        return render_template(
+            'wishlist-search.jinja', wishlists=wishlists, after=after
+        )
+
+    @classmethod
+    def _search_or_create_wishlist(cls, name="Default"):
+        """
+        Search wishlist according to name.
+        if wishlist exist return wishlist, if not create a
+        new wishlist named Default and return that wishlist
+
+        return type: wishlist
+        """
+        wishlists = cls.search(cls._website_domain() + [
+            ('nereid_user', '=', current_user.id),
+            ('name', '=', name),
+        ], order=[('id', 'ASC')])
+        # A wishlist of the website is preferred over one without website
+        wishlists.sort(key=lambda w: w.website is None)
+        if wishlists:
+            wishlist = wishlists[0]
+        else:
+            wishlist, = cls.create([{
+                'name': name,
+                'nereid_user': current_user.id,
+                'website': request.nereid_website.id,
+            }])
+            registry.inc('wishlist_created_total')
+        return wishlist
+
+    @classmethod
+    @route('/wishlists', methods=["GET", "POST"])
+    @profiled
+    @instrumented
+    @rate_limited
+    @login_required
+    def render_wishlists(cls):
+        """
+        Render all wishlist of the current user on the website, passed
+        to the template as wishlists.
+        if request is post and name is passed then call method
+        _search_or_create_wishlist.
+        """
+        if request.method == 'POST' and request.form.get("name"):
+            wishlist = cls._search_or_create_wishlist(request.form.get("name"))
+            if request.is_xhr:
+                # TODO: send all wishlist as serialized data
+                return 'success', 200
+            return redirect(
+                url_for(
+                    'wishlist.wishlist.render_wishlist', active_id=wishlist.id
+                )
+            )
+        # Sessions which outlive the login restore once
+        if not session.get(RESTORED_KEY):
+            WishlistArchive = Pool().get('wishlist.wishlist.archive')
+            WishlistArchive.user_returned()
+        with read_replica():
+            wishlists = cls.search(cls._website_domain() + [
+                ('nereid_user', '=', current_user.id),
+            ])
+            return rendered(
+                render_template('wishlists.jinja', wishlists=wishlists)
+            )
+
+    @route(
+        '/wishlists/<int:active_id>',
+        methods=["POST", "GET", "DELETE"]
+    )
+    @profiled
+    @instrumented
+    @rate_limited
+    @login_required
+    @replica_reads
+    def render_wishlist(self):
+        """
+        Render specific wishlist of current user.
+        rename wishlist on post  and delete on delete request
+        Public wishlists of other users can be rendered too.
+
+        GET requests carrying a matching If-None-Match header are answered
+        with 304 without rendering. POST and DELETE requests carrying an
+        If-Match header which does not match the current version are
+        rejected with 412, a change of the annotations alone does not
+        reject them.
+        """
+        Wishlist = Pool().get('wishlist.wishlist')
+
+        if not self._on_website():
+            abort(404)
+        if self.nereid_user != current_user and \
+                not (self.public and request.method == "GET"):
+            abort(404)
+
+        etag = None
+        if request.method == "GET":
+            etag = self.get_etag()
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+        elif request.if_match and not self.matches_version(request.if_match):
+            abort(412)
+
+        if request.method == "POST" and request.form.get('name'):
+            return self._rename(request.form.get('name'))
+
+        elif request.method == "POST" and 'public' in request.form:
+            return self._publish(
+                request.form.get('public') in ('1', 'true', 'on')
+            )
+
+        elif request.method == "DELETE":
+            Wishlist.delete([self])
+            Wishlist._refresh_membership()
+            if request.is_xhr:
+                # TODO: send serialized data of current wishlist
+                return 'success', 200
+
+            return url_for('wishlist.wishlist.render_wishlists')
+
+        response = rendered(
+            render_template(
+                'wishlist.jinja', wishlist=self,
+                annotations=self.get_item_annotations()
+            )
+        )
+        response.set_etag(etag or self.get_etag())
+        return response
+
+    def _rename(self, name):
+        """
+        Rename the wishlist for render_wishlist, unless the user has another
+        wishlist with that name.
+        """
+        if self.search(self._website_domain() + [
+                ('nereid_user', '=', current_user.id),
+                ('name', '=', name),
+                ], limit=1):
+            flash(
+                _(
+                    'Wishlist with name: %(name)s already exists.',
+                    name=name
+                )
+            )
+            return redirect(request.referrer)
+
+        self.name = name
+        self.save()
+        flash(_('Changed name of wishlist to %(name)s.', name=name))
+        return self._changed_response()
+
+    def _publish(self, public):
+        """
+        Make the wishlist public or private for render_wishlist.
+        """
+        self.public = public
+        self.save()
+        return self._changed_response()
+
+    def _changed_response(self):
+        """
+        Return the response of render_wishlist to a change of the wishlist:
+        its new ETag to XHR requests and a redirect otherwise.
+        """
+        if request.is_xhr:
+            response = make_response('success', 200)
+            response.set_etag(self.get_etag())
+            return response
+
+        return redirect(request.referrer)
+
+    @classmethod
+    @route('/wishlists/products', methods=["POST"])
+    @profiled
+    @instrumented
+    @rate_limited
+    @login_required
+    def wishlist_product(cls):
+        """
+        Add/Remove product in wishlist.
+        If wishlist_id is passed then search for wishlist and add/remove
+        product else create a default wishlist and add product.
+
+        :params
+            wishlist: Get the id of wishlist
+            product: Get product id
+            action: add or remove, add will add product to wishlist.
+                remove will unlink product from wishlist
+        """
+        Product = Pool().get('product.product')
+
+        wishlist_id = request.form.get("wishlist", type=int)
+        if wishlist_id:
+            try:
+                wishlist, = cls.search(cls._website_domain() + [
+                    ('id', '=', wishlist_id),
+                    ('nereid_user', '=', current_user.id),
+                ])
+            except ValueError:
+                from wtforms import ValidationError
+                raise ValidationError("Wishlist not valid!")
+        else:
+            wishlist = cls._search_or_create_wishlist()
+        product_id = request.form.get("product", type=int)
+        if not Product.is_wishlist_eligible(product_id) or \
+                request.form.get('action') not in ['add', 'remove']:
+            registry.inc('wishlist_ineligible_product_total')
+            abort(404)
+        cls.write([wishlist], {
+            'products': [(request.form.get('action'), [product_id])],
+        })
+        cls._refresh_membership()
+        if request.is_xhr:
+            # TODO: Send serailized data of wishllist
+            return 'success', 200
+
+        return redirect(
+            url_for(
+                'wishlist.wishlist.render_wishlist',
+                active_id=wishlist.id
+            )
+        )
+
+    @classmethod
+    @route('/wishlists/badge', methods=["GET"])
+    @replica_reads
+    def render_badge(cls):
+        """
+        Return the number of wishlists and of wishlisted products of the
+        current user as JSON.
+        """
+        return jsonify(cls.get_current_badge())
+
+    @classmethod
+    @route('/wishlists/metrics', methods=["GET"])
+    def render_metrics(cls):
+        """
+        Expose the wishlist metrics in the Prometheus text format.
+
+        Only the configured addresses, or the requests carrying the
+        configured token, may read them (see metrics).
+        """
+        if not may_read_metrics():
+            abort(404)
+
+        response = make_response(registry.exposition())
+        response.mimetype = 'text/plain'
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return response
+
+    @route('/wishlists/<int:active_id>/merge', methods=["POST"])
+    @rate_limited
+    @login_required
+    def merge_wishlist(self):
+        """
+        Merge this wishlist into another wishlist of the current user.
+
+        :params
+            target: Get the id of the wishlist to merge into
+        """
+        if self.nereid_user != current_user or not self._on_website():
+            abort(404)
+
+        try:
+            target, = self.search(self._website_domain() + [
+                ('id', '=', request.form.get('target', type=int)),
+                ('id', '!=', self.id),
+                ('nereid_user', '=', current_user.id),
+            ])
+        except ValueError:
+            abort(404)
+
+        self.merge(self, target)
+        if request.is_xhr:
+            return 'success', 200
+
+        return redirect(
+            url_for(
+                'wishlist.wishlist.render_wishlist',
+                active_id=target.id
+            )
+        )
+
+    @route('/wishlists/<int:active_id>/duplicate', methods=["POST"])
+    @rate_limited
+    @login_required
+    def duplicate_wishlist(self):
+        """
+        Copy this wishlist to a new wishlist of the current user.
+
+        :params
+            name: Get the name of the new wishlist
+        """
+        if self.nereid_user != current_user or not self._on_website():
+            abort(404)
+
+        name = request.form.get('name')
+        if not name:
+            abort(400)
+
+        if self.search(self._website_domain() + [
+                ('nereid_user', '=', current_user.id),
+                ('name', '=', name),
+                ], limit=1):
+            flash(
+                _(
+                    'Wishlist with name: %(name)s already exists.',
+                    name=name
+                )
+            )
+            return redirect(request.referrer)
+
+        wishlist = self.duplicate(self, name)
+        if request.is_xhr:
+            return 'success', 200
+
+        return redirect(
+            url_for(
+                'wishlist.wishlist.render_wishlist',
+                active_id=wishlist.id
+            )
+        )
+
+    @classmethod
+    def get_changes(cls, nereid_user, website, since=0):
+        """
+        Return the changes to the wishlists of the user on the website after
+        the sync sequence since::
+
+            {
+                'cursor': ..,
+                'wishlists': [{'id': .., 'name': .., 'public': ..,
+                    'version': ..}],
+                'items': [{'wishlist': .., 'product': ..}],
+                'removed_wishlists': [..],
+                'removed_items': [{'wishlist': .., 'product': ..}],
+            }
+
+        Removals must be applied before the other changes. With since 0 all
+        the wishlists and items are returned. Each list is read with one
+        range query on an index of the sync sequence, so the cost grows
+        with the number of changes and not with the size of the wishlists.
+        """
+        pool = Pool()
+        NereidUser = pool.get('nereid.user')
+        Relation = pool.get('product.wishlist-product')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+        Purge = pool.get('product.wishlist.purge')
+        cursor = Transaction().cursor
+        user = NereidUser.__table__()
+        table = cls.__table__()
+        relation = Relation.__table__()
+        tombstone = Tombstone.__table__()
+
+        # The transaction is repeatable read, the cursor matches the rows
+        cursor.execute(*user.select(
+            Coalesce(user.wishlist_sync, 0), where=(user.id == nereid_user)
+        ))
+        sequence, = cursor.fetchone()
+
+        where = (table.nereid_user == nereid_user) \
+            & cls._website_where(table, website)
+        changed = Literal(True)
+        if since:
+            changed = (table.sync_sequence > since)
+        cursor.execute(*table.select(
+            table.id, table.name, table.public, table.version,
+            where=where & changed,
+            order_by=table.id.asc
+        ))
+        wishlists = [{
+            'id': id_,
+            'name': name,
+            'public': bool(public),
+            'version': version,
+        } for id_, name, public, version in cursor.fetchall()]
+
+        if since:
+            changed = (relation.sync_sequence > since)
+        cursor.execute(*relation.join(
+            table, condition=(relation.wishlist == table.id)
+        ).select(
+            relation.wishlist, relation.product,
+            where=where & changed & Purge.visible(relation.product),
+            order_by=relation.id.asc
+        ))
+        items = [{
+            'wishlist': wishlist_id,
+            'product': product_id,
+        } for wishlist_id, product_id in cursor.fetchall()]
+
+        removed_wishlists, removed_items = [], []
+        if since:
+            cursor.execute(*tombstone.select(
+                tombstone.wishlist, tombstone.product,
+                where=(tombstone.nereid_user == nereid_user)
+                & cls._website_where(tombstone, website)
+                & (tombstone.sync_sequence > since),
+                order_by=tombstone.id.asc
+            ))
+            for wishlist_id, product_id in cursor.fetchall():
+                if product_id is None:
+                    removed_wishlists.append(wishlist_id)
+                else:
+                    removed_items.append({
+                        'wishlist': wishlist_id,
+                        'product': product_id,
+                    })
+
+        return {
+            'cursor': sequence,
+            'wishlists': wishlists,
+            'items': items,
+            'removed_wishlists': removed_wishlists,
+            'removed_items': removed_items,
+        }
+
+    @classmethod
+    @route('/wishlists/sync', methods=["GET"])
+    @instrumented
+    @login_required
+    @replica_reads
+    def render_sync(cls):
+        """
+        Return the changes to the wishlists of the current user since the
+        previous sync as JSON.
+
+        :params
+            cursor: Get the cursor returned by the previous sync, 0 or
+                nothing for a full sync
+        """
+        return jsonify(cls.get_changes(
+            current_user.id, request.nereid_website.id,
+            request.args.get('cursor', 0, type=int)
+        ))
+
+
+class ProductWishlistRelationship(ModelSQL):
+    """
+    This is the relation between wishlist and a product.
+    """
+    __name__ = 'product.wishlist-product'
+
+    product = fields.Many2One(
+        'product.product', 'Product',
+        domain=[
+            ('displayed_on_eshop', '=', True),
+            ('template.active', '=', True),
+        ],
+        ondelete='CASCADE', select=True, required=True,
+    )
+    wishlist = fields.Many2One(
+        'wishlist.wishlist', 'Wishlist',
+        ondelete='CASCADE', select=True, required=True
+    )
+    sync_sequence = fields.Integer('Sync Sequence', readonly=True)
+    active = fields.Function(
+        fields.Boolean('Active'), 'get_active', searcher='search_active'
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ProductWishlistRelationship, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['wishlist', 'sync_sequence'], 'add')
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        History = pool.get('wishlist.wishlist.history')
+
+        records = super(ProductWishlistRelationship, cls).create(vlist)
+        added = defaultdict(list)
+        for values in vlist:
+            if values.get('wishlist'):
+                added[values['wishlist']].append(values.get('product'))
+        History.log('add', added)
+        Wishlist._bump_version(list(added))
+        cls._sync_links(list(added))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        actions = iter(args)
+        ids = []
+        moved = []
+        removed = defaultdict(list)
+        for records, values in zip(actions, actions):
+            ids.extend([r.wishlist.id for r in records])
+            if values.get('wishlist'):
+                ids.append(values['wishlist'])
+            if 'wishlist' in values or 'product' in values:
+                moved.extend([r.id for r in records])
+                for record in records:
+                    removed[record.wishlist.id].append(record.product.id)
+        super(ProductWishlistRelationship, cls).write(*args)
+
+        # Moved links are synced as a removal and an addition
+        Tombstone.bury(removed)
+        for i in range(0, len(moved), cursor.IN_MAX):
+            cursor.execute(*table.update(
+                columns=[table.sync_sequence],
+                values=[Null],
+                where=reduce_ids(table.id, moved[i:i + cursor.IN_MAX])
+            ))
+        Wishlist._bump_version(ids)
+        cls._sync_links(ids)
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        History = pool.get('wishlist.wishlist.history')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+
+        deleted = set(Transaction().context.get('_wishlist_deleted') or [])
+        removed = defaultdict(list)
+        for record in records:
+            if record.wishlist.id not in deleted:
+                removed[record.wishlist.id].append(record.product.id)
+        super(ProductWishlistRelationship, cls).delete(records)
+        History.log('remove', removed)
+        Tombstone.bury(removed)
+        Wishlist._bump_version(list(removed))
+
+    @classmethod
+    def get_active(cls, records, name):
+        """
+        Links to products queued for purge are inactive.
+        """
+        Purge = Pool().get('product.wishlist.purge')
+
+        queued = set(Purge.queued([r.product.id for r in records]))
+        return dict((r.id, r.product.id not in queued) for r in records)
+
+    @classmethod
+    def search_active(cls, name, clause):
+        Purge = Pool().get('product.wishlist.purge')
+        queue = Purge.__table__()
+
+        _, operator, value = clause
+        active = (operator == '=') == bool(value)
+        return [
+            ('product', 'not in' if active else 'in',
+                queue.select(queue.product)),
+        ]
+
+    @classmethod
+    def _sync_links(cls, wishlist_ids):
+        """
+        Give the links of the wishlists which have no sync sequence, the
+        ones just created, the sync sequence of their wishlist.
+        """
+        Wishlist = Pool().get('wishlist.wishlist')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        wishlist = Wishlist.__table__()
+
+        wishlist_ids = list(set(wishlist_ids))
+        for i in range(0, len(wishlist_ids), cursor.IN_MAX):
+            sub_ids = wishlist_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.update(
+                columns=[table.sync_sequence],
+                values=[wishlist.select(
+                    wishlist.sync_sequence,
+                    where=(wishlist.id == table.wishlist)
+                )],
+                where=reduce_ids(table.wishlist, sub_ids)
+                & (table.sync_sequence == Null)
+            ))
+
+
+class ProductWishlistPurge(ModelSQL):
+    """
+    Queue of the products whose wishlist links are removed in the
+    background.
+
+    Delisting or deleting many products at once would otherwise remove
+    millions of links in one statement, locking the links table for
+    minutes. The links of queued products are hidden at once and removed
+    by process in small batches.
+    """
+    __name__ = 'product.wishlist.purge'
+
+    product = fields.Many2One(
+        'product.product', 'Product', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    delete_product = fields.Boolean(
+        'Delete Product',
+        help='Delete the product once its links are removed'
+    )
+
+    @staticmethod
+    def default_delete_product():
+        return False
+
+    @classmethod
+    def visible(cls, product):
+        """
+        Return the condition excluding the queued products, product being
+        the product column of a query.
+        """
+        queue = cls.__table__()
+        return ~product.in_(queue.select(queue.product))
+
+    @classmethod
+    def queued(cls, product_ids):
+        """
+        Return the ids among product_ids which are queued.
+        """
+        cursor = Transaction().cursor
+        queue = cls.__table__()
+
+        result = []
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*queue.select(
+                queue.product, where=reduce_ids(queue.product, sub_ids)
+            ))
+            result.extend([product_id for product_id, in cursor.fetchall()])
+        return result
+
+    @classmethod
+    def linked(cls, product_ids):
+        """
+        Return the set of the ids among product_ids which are in a
+        wishlist.
+        """
+        Relation = Pool().get('product.wishlist-product')
+        cursor = Transaction().cursor
+        relation = Relation.__table__()
+
+        result = set()
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*relation.select(
+                relation.product,
+                where=reduce_ids(relation.product, sub_ids),
+                distinct=True
+            ))
+            result.update([product_id for product_id, in cursor.fetchall()])
+        return result
+
+    @classmethod
+    def enqueue(cls, product_ids, delete=False):
+        """
+        Queue the products which are in a wishlist and not queued yet.
+        With delete, the products are also deleted once purged.
+        """
+        Relation = Pool().get('product.wishlist-product')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        queue = cls.__table__()
+        existing = cls.__table__()
+        relation = Relation.__table__()
+
+        product_ids = list(set(product_ids))
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*queue.insert(
+                columns=[
+                    queue.create_uid, queue.create_date,
+                    queue.product, queue.delete_product,
+                ],
+                values=relation.select(
+                    Literal(transaction.user), CurrentTimestamp(),
+                    relation.product, Literal(False),
+                    where=reduce_ids(relation.product, sub_ids)
+                    & ~relation.product.in_(existing.select(existing.product)),
+                    distinct=True
+                )
+            ))
+            if delete:
+                cursor.execute(*queue.update(
+                    columns=[queue.delete_product],
+                    values=[True],
+                    where=reduce_ids(queue.product, sub_ids)
+                ))
+
+    @classmethod
+    def process(cls, batch_size=500, pause=0.1, commit=True):
+        """
+        Remove the links of the queued products, batch_size at a time,
+        committing and sleeping pause seconds after each batch so that
+        wishlist writes are not stalled. Products listed again since they
+        were queued are dropped from the queue and keep their links.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Wishlist = pool.get('wishlist.wishlist')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+        transaction = Transaction()
+        relation = Relation.__table__()
+        queue = cls.__table__()
+
+        cls.delete([
+            q for q in cls.search([('delete_product', '=', False)])
+            if q.product.displayed_on_eshop and q.product.template.active
+        ])
+
+        while True:
+            cursor = transaction.cursor
+            cursor.execute(*relation.select(
+                relation.id, relation.wishlist, relation.product,
+                where=relation.product.in_(queue.select(queue.product)),
+                limit=batch_size
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            removed = defaultdict(list)
+            for _, wishlist_id, product_id in rows:
+                removed[wishlist_id].append(product_id)
+            Tombstone.bury(removed)
+            cursor.execute(*relation.delete(
+                where=reduce_ids(relation.id, [r[0] for r in rows])
+            ))
+            Wishlist._bump_version(list(removed))
+            if commit:
+                cursor.commit()
+            logger.info('Purged %d wishlist links', len(rows))
+            if pause:
+                time.sleep(pause)
+
+        # Products queued while the batches ran still have links
+        purged = cls.search([])
+        linked = cls.linked([q.product.id for q in purged])
+        purged = [q for q in purged if q.product.id not in linked]
+        products = [q.product for q in purged if q.delete_product]
+        cls.delete(purged)
+        if commit:
+            transaction.cursor.commit()
+        for product in products:
+            cls._delete_product(product, commit=commit)
+
+    @classmethod
+    def _delete_product(cls, product, commit=True):
+        """
+        Delete a purged product, which is already dropped from the queue. A
+        product which can not be deleted, for example as it was sold or
+        moved in stock, is logged and stays delisted, so that it does not
+        fail every run.
+
+        The references to the product are checked before anything is
+        deleted, so their error leaves the transaction usable. An integrity
+        error of the database aborts it on PostgreSQL, it is rolled back
+        when committing and raised otherwise.
+        """
+        Product = Pool().get('product.product')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().cursor
+
+        try:
+            Product.delete([product])
+        except (UserError, DatabaseIntegrityError) as exception:
+            if isinstance(exception, DatabaseIntegrityError):
+                if not commit:
+                    raise
+                cursor.rollback()
+            logger.warning(
+                'Purged product %d could not be deleted', product.id,
+                exc_info=True
+            )
+        else:
+            if commit:
+                cursor.commit()
+
+
+class ProductRecommendation(ModelSQL):
+    """
+    Products which are wishlisted together with a product.
+
+    The rows are computed offline from product.wishlist-product by
+    refresh, keeping the top scored neighbours of each product.
+    """
+    __name__ = 'product.wishlist.recommendation'
+
+    product = fields.Many2One(
+        'product.product', 'Product',
+        ondelete='CASCADE', required=True,
+    )
+    recommended = fields.Many2One(
+        'product.product', 'Recommended Product',
+        ondelete='CASCADE', required=True,
+    )
+    score = fields.Integer('Score', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ProductRecommendation, cls).__setup__()
+        cls._order.insert(0, ('score', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ProductRecommendation, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['product', 'score'], 'add')
+
+    @classmethod
+    def _changed_products(cls, since):
+        """
+        Return the ids of the products whose neighbours may have changed
+        since the given date: the products of every wishlist changed since
+        then and the products removed from a wishlist, or whose wishlist was
+        deleted or archived, since then.
+        """
+        pool = Pool()
+        Relation = pool.get('product.wishlist-product')
+        Wishlist = pool.get('wishlist.wishlist')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+        History = pool.get('wishlist.wishlist.history')
+        Archive = pool.get('wishlist.wishlist.archive')
+        cursor = Transaction().cursor
+        relation = Relation.__table__()
+        wishlist = Wishlist.__table__()
+        tombstone = Tombstone.__table__()
+        history = History.__table__()
+        archive = Archive.__table__()
+
+        cursor.execute(*Union(
+            relation.join(
+                wishlist, condition=(relation.wishlist == wishlist.id)
+            ).select(
+                relation.product,
+                where=(relation.create_date >= since)
+                | (wishlist.create_date >= since)
+                | (wishlist.write_date >= since)
+            ),
+            tombstone.select(
+                tombstone.product,
+                where=(tombstone.create_date >= since)
+                & (tombstone.product != Null)
+            )
+        ))
+        product_ids = set(product_id for product_id, in cursor.fetchall())
+
+        # The links of deleted and archived wishlists are only recorded
+        # encoded in the history and the archive
+        for query in [
+                history.select(
+                    history.products,
+                    where=(history.create_date >= since)
+                    & (history.action == 'delete')
+                ),
+                archive.select(
+                    archive.products, where=(archive.create_date >= since)
+                )]:
+            cursor.execute(*query)
+            for products, in cursor.fetchall():
+                product_ids.update(_decode_ids(products))
+        return sorted(product_ids)
+
+    @classmethod
+    def refresh(cls, top_k=10, full=False, fetch_size=1000):
+        """
+        Recompute the recommendations.
+
+        Only the products of wishlists changed since the last refresh are
+        recomputed unless full is set or no refresh ran yet. Co-occurrence
+        counts are computed by the database with a self join of the
+        relationship table grouped by product pair, and the result is
+        streamed fetch_size rows at a time keeping top_k neighbours for
+        each product.
+        """
+        Relation = Pool().get('product.wishlist-product')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        relation = Relation.__table__()
+
+        last_refresh = None
+        if not full:
+            cursor.execute(*table.select(Max(table.create_date)))
+            last_refresh, = cursor.fetchone()
+
+        if last_refresh is None:
+            cursor.execute(*relation.select(relation.product, distinct=True))
+            product_ids = [product_id for product_id, in cursor.fetchall()]
+            cursor.execute(*table.delete())
+        else:
+            product_ids = cls._changed_products(last_refresh)
+
+        user = Transaction().user
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+
+            source = Relation.__table__()
+            neighbour = Relation.__table__()
+            cursor.execute(*source.join(
+                neighbour, condition=(source.wishlist == neighbour.wishlist)
+                & (source.product != neighbour.product)
+            ).select(
+                source.product, neighbour.product, Count(Literal(1)),
+                where=reduce_ids(source.product, sub_ids),
+                group_by=[source.product, neighbour.product],
+                order_by=[source.product]
+            ))
+
+            values = []
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                # The top neighbours of the rows seen so far and the new
+                # rows give the top neighbours of both, so memory stays
+                # bounded by top_k per product plus one fetch.
+                values = cls._top_neighbours(values + rows, top_k)
+
+            cursor.execute(*table.delete(
+                where=reduce_ids(table.product, sub_ids)
+            ))
+            if values:
+                cursor.execute(*table.insert(
+                    columns=[
+                        table.create_uid, table.create_date,
+                        table.product, table.recommended, table.score,
+                    ],
+                    values=[
+                        [user, CurrentTimestamp(), product, recommended,
+                            score]
+                        for product, recommended, score in values
+                    ]
+                ))
+
+    @staticmethod
+    def _top_neighbours(rows, top_k):
+        """
+        Return the top_k rows by score for each product of the
+        (product, recommended, score) rows, which are sorted by product.
+        """
+        result = []
+        for _, neighbours in groupby(rows, key=itemgetter(0)):
+            result.extend(heapq.nlargest(top_k, neighbours, key=itemgetter(2)))
+        return result
+
+
+class WishlistHistory(ModelSQL):
+    """
+    Append-only log of the changes made to wishlists.
+
+    Each row stores only the products added or removed by one change, as
+    encoded by _encode_ids, so that a deleted wishlist can be restored and
+    the last change of a wishlist can be undone.
+    """
+    __name__ = 'wishlist.wishlist.history'
+
+    # Not a Many2One as the history must outlive the wishlist
+    wishlist = fields.Integer('Wishlist', required=True)
+    nereid_user = fields.Many2One(
+        'nereid.user', 'Nereid User', ondelete='CASCADE', required=True,
+        select=True,
+    )
+    website = fields.Many2One(
+        'nereid.website', 'Website', ondelete='SET NULL'
+    )
+    name = fields.Char(
+        'Name', required=True,
+        help='The name of the wishlist before the change'
+    )
+    action = fields.Selection([
+        ('add', 'Add'),
+        ('remove', 'Remove'),
+        ('rename', 'Rename'),
+        ('delete', 'Delete'),
+    ], 'Action', required=True)
+    products = fields.Char('Products')
+
+    @classmethod
+    def __setup__(cls):
+        super(WishlistHistory, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(WishlistHistory, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['wishlist', 'id'], 'add')
+        table.index_action(['create_date', 'id'], 'add')
+
+    @classmethod
+    def log(cls, action, changes):
+        """
+        Record a change of the products of wishlists.
+
+        :param action: add, remove or delete
+        :param changes: dictionary of the product ids changed in each
+                        wishlist
+        """
+        Wishlist = Pool().get('wishlist.wishlist')
+        cursor = Transaction().cursor
+        wishlist = Wishlist.__table__()
+
+        if Transaction().context.get('_wishlist_history_skip'):
+            return
+        # Deleting an empty wishlist is recorded so that it can be restored
+        ids = [
+            id_ for id_, products in changes.items()
+            if products or action == 'delete'
+        ]
+        vlist = []
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*wishlist.select(
+                wishlist.id, wishlist.nereid_user, wishlist.website,
+                wishlist.name,
+                where=reduce_ids(wishlist.id, sub_ids)
+            ))
+            for id_, user, website, name in cursor.fetchall():
+                vlist.append({
+                    'wishlist': id_,
+                    'nereid_user': user,
+                    'website': website,
+                    'name': name,
+                    'action': action,
+                    'products': _encode_ids(changes[id_]),
+                })
+        if vlist:
+            cls.create(vlist)
+
+    @classmethod
+    def log_rename(cls, wishlists):
+        """
+        Record the current name of wishlists which are being renamed.
+        """
+        if Transaction().context.get('_wishlist_history_skip'):
+            return
+        cls.create([{
+            'wishlist': w.id,
+            'nereid_user': w.nereid_user.id,
+            'website': w.website and w.website.id,
+            'name': w.name,
+            'action': 'rename',
+        } for w in wishlists])
+
+    def undo(self):
+        """
+        Revert this change and remove it from the history.
+
+        Return the id of the wishlist, which is a new one when a deleted
+        wishlist is restored.
+        """
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        Relation = pool.get('product.wishlist-product')
+
+        wishlist_id = self.wishlist
+        product_ids = _decode_ids(self.products)
+        with Transaction().set_context(_wishlist_history_skip=True):
+            if self.action == 'delete':
+                wishlist, = Wishlist.create([{
+                    'name': self.name,
+                    'nereid_user': self.nereid_user.id,
+                    'website': self.website and self.website.id,
+                }])
+                wishlist_id = wishlist.id
+                Wishlist._link_products(wishlist_id, product_ids)
+                self._remap_wishlist(self.wishlist, wishlist_id)
+            elif self.action == 'remove':
+                Wishlist._link_products(wishlist_id, product_ids)
+            elif self.action == 'add':
+                Relation.delete(Relation.search([
+                    ('wishlist', '=', wishlist_id),
+                    ('product', 'in', product_ids),
+                ]))
+            elif self.action == 'rename':
+                Wishlist.write([Wishlist(wishlist_id)], {'name': self.name})
+        self.delete([self])
+        return wishlist_id
+
+    @classmethod
+    def _remap_wishlist(cls, old_id, new_id):
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+            columns=[table.wishlist],
+            values=[new_id],
+            where=(table.wishlist == old_id)
+        ))
+
+    @classmethod
+    @route('/wishlists/history/<int:wishlist_id>/undo', methods=["POST"])
+    @rate_limited
+    @login_required
+    def undo_change(cls, wishlist_id):
+        """
+        Undo the last change of a wishlist of the current user. A deleted
+        wishlist is restored with its products.
+        """
+        try:
+            change, = cls.search([
+                ('wishlist', '=', wishlist_id),
+                ('nereid_user', '=', current_user.id),
+                ('website', '=', request.nereid_website.id),
+            ], limit=1)
+        except ValueError:
+            abort(404)
+
+        wishlist_id = change.undo()
+        if request.is_xhr:
+            return 'success', 200
+
+        return redirect(
+            url_for(
+                'wishlist.wishlist.render_wishlist',
+                active_id=wishlist_id
+            )
+        )
+
+    @classmethod
+    def compact(cls, age=1):
+        """
+        Merge the consecutive add and remove changes older than age days of
+        each wishlist into their net change.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=age)
+
+        cursor.execute(*table.select(
+            table.wishlist,
+            where=(table.create_date < cutoff)
+            & table.action.in_(['add', 'remove']),
+            group_by=table.wishlist,
+            having=Count(table.id) > 2
+        ))
+        wishlist_ids = [id_ for id_, in cursor.fetchall()]
+
+        for wishlist_id in wishlist_ids:
+            changes = cls.search([
+                ('wishlist', '=', wishlist_id),
+                ('create_date', '<', cutoff),
+            ], order=[('id', 'ASC')])
+            for _, run in groupby(
+                    changes, key=lambda c: c.action in ('add', 'remove')):
+                run = list(run)
+                if len(run) > 2 and run[0].action in ('add', 'remove'):
+                    cls._compact_run(run)
+
+    @classmethod
+    def _compact_run(cls, changes):
+        """
+        Replace a run of add and remove changes by their net change.
+
+        The net change is stored on the last rows of the run so that the
+        order of the history is kept.
+        """
+        added, removed = set(), set()
+        for change in changes:
+            product_ids = set(_decode_ids(change.products))
+            if change.action == 'add':
+                added |= product_ids - removed
+                removed -= product_ids
+            else:
+                removed |= product_ids - added
+                added -= product_ids
+
+        net = [
+            (action, product_ids)
+            for action, product_ids in (('remove', removed), ('add', added))
+            if product_ids
+        ]
+        kept = changes[len(changes) - len(net):]
+        cls.delete(changes[:len(changes) - len(net)])
+        for change, (action, product_ids) in zip(kept, net):
+            cls.write([change], {
+                'action': action,
+                'products': _encode_ids(product_ids),
+            })
+
+    @classmethod
+    def purge(cls, retention=90, chunk_size=1000, commit=True):
+        """
+        Delete the changes older than retention days, chunk_size rows per
+        transaction when commit is set.
+        """
+        transaction = Transaction()
+        table = cls.__table__()
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=retention)
+
+        while True:
+            cursor = transaction.cursor
+            cursor.execute(*table.select(
+                table.id,
+                where=(table.create_date < cutoff),
+                order_by=table.id.asc,
+                limit=chunk_size
+            ))
+            ids = [id_ for id_, in cursor.fetchall()]
+            if not ids:
+                break
+            cursor.execute(*table.delete(where=reduce_ids(table.id, ids)))
+            if commit:
+                cursor.commit()
+
+    @classmethod
+    def maintain(cls):
+        """
+        Compact and purge the history. Called by the scheduler.
+        """
+        cls.compact()
+        cls.purge()
+
+
+class WishlistArchive(ModelSQL):
+    """
+    Cold storage of stale wishlists.
+
+    The wishlists of a user who did not come back for long are stale. A
+    stale wishlist and its links are moved to a single row, with the ids
+    of its products encoded by _encode_ids, and moved back with the same
+    id when its user comes back.
+    """
+    __name__ = 'wishlist.wishlist.archive'
+
+    wishlist = fields.Integer('Wishlist', required=True)
+    nereid_user = fields.Many2One(
+        'nereid.user', 'Nereid User', ondelete='CASCADE', required=True,
+        select=True,
+    )
+    website = fields.Many2One(
+        'nereid.website', 'Website', ondelete='SET NULL'
+    )
+    name = fields.Char('Name', required=True)
+    public = fields.Boolean('Public')
+    products = fields.Char('Products')
+
+    @staticmethod
+    def default_public():
+        return False
+
+    @classmethod
+    def _stale_query(cls, cutoff, last_id, batch_size):
+        """
+        Return the query of the next batch_size stale wishlists after
+        last_id: the wishlists of the users who did not log in since cutoff
+        and of inactive users.
+        """
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        NereidUser = pool.get('nereid.user')
+        wishlist = Wishlist.__table__()
+        user = NereidUser.__table__()
+
+        last_login = Coalesce(user.wishlist_last_login, user.create_date)
+        return wishlist.join(
+            user, condition=(wishlist.nereid_user == user.id)
+        ).select(
+            wishlist.id, wishlist.nereid_user, wishlist.website,
+            wishlist.name, wishlist.public,
+            where=(wishlist.id > last_id) & (
+                (last_login < cutoff)
+                | (user.active == False)  # noqa
+            ),
+            order_by=wishlist.id.asc,
+            limit=batch_size
+        )
+
+    @classmethod
+    def archive(cls, age=730, batch_size=500, commit=True):
+        """
+        Move the wishlists of the users who did not log in for age days,
+        and of inactive users, to the archive. Each batch of batch_size
+        wishlists is moved and, unless commit is unset, committed on its
+        own.
+
+        Return a dictionary with the number of wishlists and of links
+        moved.
+        """
+        transaction = Transaction()
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=age)
+
+        moved = {'wishlists': 0, 'links': 0}
+        last_id = 0
+        while True:
+            cursor = transaction.cursor
+            cursor.execute(*cls._stale_query(cutoff, last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            moved['links'] += cls.archive_rows(rows)
+            moved['wishlists'] += len(rows)
+            if commit:
+                cursor.commit()
+
+        logger.info(
+            'Archived %(wishlists)d wishlists and %(links)d links', moved
+        )
+        return moved
+
+    @classmethod
+    def archive_rows(cls, rows):
+        """
+        Move the wishlists of the (id, nereid_user, website, name, public)
+        rows and their links to the archive.
+
+        Return the number of links moved.
+        """
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        Relation = pool.get('product.wishlist-product')
+        Tombstone = pool.get('wishlist.wishlist.tombstone')
+        cursor = Transaction().cursor
+        wishlist = Wishlist.__table__()
+        relation = Relation.__table__()
+
+        ids = [row[0] for row in rows]
+        products = Wishlist._get_product_ids(ids)
+        Tombstone.bury(dict.fromkeys(ids))
+        cls.create([{
+            'wishlist': id_,
+            'nereid_user': user,
+            'website': website,
+            'name': name,
+            'public': public,
+            'products': _encode_ids(products[id_]),
+        } for id_, user, website, name, public in rows])
+        cursor.execute(*relation.delete(
+            where=reduce_ids(relation.wishlist, ids)
+        ))
+        cursor.execute(*wishlist.delete(
+            where=reduce_ids(wishlist.id, ids)
+        ))
+        return sum(len(p) for p in products.values())
+
+    @classmethod
+    def restore(cls, nereid_user, website=None):
+        """
+        Move the archived wishlists of the user on the website back with
+        their original id. Their products are added to any wishlist created
+        since with the same name instead.
+
+        Archives and wishlists without a website belong to every website.
+        """
+        Wishlist = Pool().get('wishlist.wishlist')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        wishlist = Wishlist.__table__()
+
+        domain = [
+            ('nereid_user', '=', nereid_user),
+            [
+                'OR',
+                ('website', '=', website),
+                ('website', '=', None),
+            ],
+        ]
+        archives = cls.search(domain)
+        if not archives:
+            return
+
+        for archive in archives:
+            wishlists = Wishlist.search(domain + [
+                ('name', '=', archive.name),
+            ], limit=1)
+            if wishlists:
+                wishlist_id = wishlists[0].id
+            else:
+                # The id is never reused by the sequence, so the history
+                # and the clients keep following the wishlist
+                wishlist_id = archive.wishlist
+                cursor.execute(*wishlist.insert(
+                    columns=[
+                        wishlist.id, wishlist.create_uid,
+                        wishlist.create_date, wishlist.nereid_user,
+                        wishlist.website, wishlist.name, wishlist.public,
+                        wishlist.version,
+                    ],
+                    values=[[
+                        wishlist_id, transaction.user, CurrentTimestamp(),
+                        nereid_user, archive.website and archive.website.id,
+                        archive.name, bool(archive.public),
+                        Wishlist.default_version(),
+                    ]]
+                ))
+                Wishlist._bump_version([wishlist_id], version=False)
+            Wishlist._link_products(
+                wishlist_id, _decode_ids(archive.products)
+            )
+        cls.delete(archives)
+
+    @classmethod
+    def user_returned(cls):
+        """
+        Record that the current user came back and move their archived
+        wishlists on the website back.
+        """
+        NereidUser = Pool().get('nereid.user')
+
+        NereidUser._record_wishlist_login(current_user.id)
+        cls.restore(current_user.id, request.nereid_website.id)
+        session[RESTORED_KEY] = True
+
+
+@login.connect
+def restore_archived_wishlists(sender, **extra):
+    """
+    Record the login of users and restore their archived wishlists.
+    """
+    try:
+        WishlistArchive = Pool().get('wishlist.wishlist.archive')
+    except KeyError:
+        # The module is not installed on this database
+        return
+    WishlistArchive.user_returned()
+
+
+@request_started.connect
+def warm_up_caches(sender, **extra):
+    """
+    Warm up the wishlist caches in the background on the first request of
+    the worker when WISHLIST_WARMUP is set.
+    """
+    if sender.config.get('WISHLIST_WARMUP'):
+        start_warm_up(sender)
+
+
+class WishlistTombstone(ModelSQL):
+    """
+    Removal of a wishlist, or of a product from a wishlist, kept for the
+    delta sync of the clients.
+    """
+    __name__ = 'wishlist.wishlist.tombstone'
+
+    wishlist = fields.Integer('Wishlist', required=True)
+    product = fields.Integer(
+        'Product', help='Empty when the wishlist itself was removed'
+    )
+    nereid_user = fields.Many2One(
+        'nereid.user', 'Nereid User', required=True, ondelete='CASCADE'
+    )
+    website = fields.Many2One(
+        'nereid.website', 'Website', ondelete='CASCADE'
+    )
+    sync_sequence = fields.Integer('Sync Sequence', required=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(WishlistTombstone, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['nereid_user', 'sync_sequence'], 'add')
+
+    @classmethod
+    def bury(cls, removed):
+        """
+        Record removals for the delta sync. removed maps the id of each
+        wishlist to the ids of the products removed from it, or to None
+        when the wishlist itself is removed.
+
+        The tombstones of each user take the next sync sequence of the
+        user.
+        """
+        pool = Pool()
+        Wishlist = pool.get('wishlist.wishlist')
+        NereidUser = pool.get('nereid.user')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+        wishlist = Wishlist.__table__()
+        user = NereidUser.__table__()
+
+        ids = [id_ for id_, products in removed.items() if products != []]
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            NereidUser._next_wishlist_sync(wishlist.select(
+                wishlist.nereid_user, where=reduce_ids(wishlist.id, sub_ids)
+            ))
+            cursor.execute(*wishlist.join(
+                user, condition=(wishlist.nereid_user == user.id)
+            ).select(
+                wishlist.id, wishlist.nereid_user, wishlist.website,
+                user.wishlist_sync,
+                where=reduce_ids(wishlist.id, sub_ids)
+            ))
+            values = []
+            for id_, user_id, website_id, sequence in cursor.fetchall():
+                products = removed[id_]
+                if products is None:
+                    products = [None]
+                values.extend([[
+                    transaction.user, CurrentTimestamp(),
+                    id_, product_id, user_id, website_id, sequence,
+                ] for product_id in products])
+            if values:
+                cursor.execute(*table.insert(
+                    columns=[
+                        table.create_uid, table.create_date,
+                        table.wishlist, table.product, table.nereid_user,
+                        table.website, table.sync_sequence,
+                    ],
+                    values=values
+                ))